@@ -1,4 +1,7 @@
+from django.conf import settings
+
 from djangae.contrib.common import _thread_locals
+from djangae.db.backends.appengine import cache_stats
 
 
 class RequestStorageMiddleware:
@@ -17,3 +20,14 @@ class RequestStorageMiddleware:
     def process_exception(self, request, exception):
         _thread_locals.request = None
         return None  # Allow default exception handling to take over
+
+
+class CacheStatsMiddleware(object):
+    """ Debug middleware which adds a summary of the datastore caching layer's stats for the request
+        to the response, in the X-Djangae-Cache-Stats header. It does nothing unless DEBUG is True.
+    """
+
+    def process_response(self, request, response):
+        if settings.DEBUG:
+            response["X-Djangae-Cache-Stats"] = cache_stats.get_request_stats().summary()
+        return response
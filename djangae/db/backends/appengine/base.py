@@ -44,7 +44,6 @@ from .commands import (
     UpdateCommand,
     DeleteCommand,
     coerce_unicode,
-    get_field_from_column
 )
 
 from djangae.db.backends.appengine import dbapi as Database
@@ -114,40 +113,46 @@ class Cursor(object):
         if entity is None:
             return None
 
-        ## FIXME: Move this to SelectCommand.next_result()
-        result = []
+        return self._build_rows([entity])[0]
 
-        # If there is extra_select prepend values to the results list
-        for col, query in self.last_select_command.extra_select.items():
-            result.append(entity.get(col))
-
-        for col in self.last_select_command.queried_fields:
-            if col == "__key__":
-                key = entity if isinstance(entity, Key) else entity.key()
-                self.returned_ids.append(key)
-                result.append(key.id_or_name())
-            else:
-                field = get_field_from_column(self.last_select_command.model, col)
-                value = self.connection.ops.convert_values(entity.get(col), field)
-                result.append(value)
+    def fetchmany(self, size, delete_flag=False):
+        results = self.last_select_command.results
+        if not results:
+            return []
 
-        return result
+        if isinstance(results, (int, long)):
+            # Handle aggregate (e.g. count), as fetchone does
+            return [ (results, ) ] * size
 
-    def fetchmany(self, size, delete_flag=False):
-        if not self.last_select_command.results:
+        return self._build_rows(self.last_select_command.next_results(size))
+
+    def _build_rows(self, entities):
+        """
+            Converts the entities into rows, a column at a time so that each column's converter
+            is only looked up once for the whole batch
+        """
+        if not entities:
             return []
 
-        result = []
-        i = 0
-        while i < size:
-            entity = self.fetchone(delete_flag)
-            if entity is None:
-                break
+        # If there is extra_select prepend values to the results list
+        columns = [
+            [ entity.get(col) for entity in entities ]
+            for col in self.last_select_command.extra_select
+        ]
+
+        for col, convert in self.last_select_command.get_column_converters():
+            if convert is None:
+                # This is the __key__ column
+                keys = [ entity if isinstance(entity, Key) else entity.key() for entity in entities ]
+                self.returned_ids.extend(keys)
+                columns.append([ key.id_or_name() for key in keys ])
+            else:
+                columns.append([ convert(entity.get(col)) for entity in entities ])
 
-            result.append(entity)
-            i += 1
+        if not columns:
+            return [ [] for entity in entities ]
 
-        return result
+        return [ list(row) for row in zip(*columns) ]
 
     @property
     def lastrowid(self):
@@ -161,6 +166,23 @@ class Cursor(object):
 
 MAXINT = 9223372036854775808
 
+
+def _identity(value):
+    return value
+
+
+def _decode_string(value):
+    return value.decode("utf-8") if isinstance(value, str) else value
+
+
+def _list_or_empty(value):
+    return value or []
+
+
+def _set_or_empty(value):
+    return set(value) if value else set()
+
+
 class DatabaseOperations(BaseDatabaseOperations):
     compiler_module = "djangae.db.backends.appengine.compiler"
 
@@ -178,30 +200,49 @@ class DatabaseOperations(BaseDatabaseOperations):
 
     def convert_values(self, value, field):
         """ Called when returning values from the datastore"""
-
-        value = super(DatabaseOperations, self).convert_values(value, field)
+        return self.get_value_converter(field)(value)
+
+    def get_value_converter(self, field):
+        """
+            Returns a callable which converts a value of the field returned from the datastore (as
+            convert_values does). Everything which only depends on the field is worked out up front,
+            so when converting a lot of values get the converter once and reuse it.
+        """
+        if field is None:
+            return _identity
+
+        # This is the coercion BaseDatabaseOperations.convert_values applies to values which aren't None
+        internal_type = field.get_internal_type()
+        if internal_type == "FloatField":
+            coerce = float
+        elif internal_type and (internal_type.endswith("IntegerField") or internal_type == "AutoField"):
+            coerce = int
+        else:
+            coerce = None
 
         db_type = field.db_type(self.connection)
-        if db_type == 'string' and isinstance(value, str):
-            value = value.decode("utf-8")
+        if db_type == "string":
+            convert = _decode_string
         elif db_type == "datetime":
-            value = self.connection.ops.value_from_db_datetime(value)
+            convert = self.value_from_db_datetime
         elif db_type == "date":
-            value = self.connection.ops.value_from_db_date(value)
+            convert = self.value_from_db_date
         elif db_type == "time":
-            value = self.connection.ops.value_from_db_time(value)
+            convert = self.value_from_db_time
         elif db_type == "decimal":
-            value = self.connection.ops.value_from_db_decimal(value)
-        elif db_type == 'list':
-            if not value:
-                value = [] # Convert None back to an empty list
-        elif db_type == 'set':
-            if not value:
-                value = set()
-            else:
-                value = set(value)
+            convert = self.value_from_db_decimal
+        elif db_type == "list":
+            convert = _list_or_empty # Convert None back to an empty list
+        elif db_type == "set":
+            convert = _set_or_empty
+        else:
+            convert = None
 
-        return value
+        if coerce is None:
+            return convert or _identity
+        elif convert is None:
+            return lambda value: value if value is None else coerce(value)
+        return lambda value: convert(value if value is None else coerce(value))
 
     def sql_flush(self, style, tables, seqs, allow_cascade=False):
         return [ FlushCommand(table) for table in tables ]
@@ -0,0 +1,183 @@
+"""
+    Counters for the datastore caching layers, broken down by kind, so that you can see
+    how effective the caches are. Stats are kept for the current request, and are added
+    to the stats for the process when the request finishes.
+"""
+import copy
+import logging
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.dispatch import receiver
+from django.utils.importlib import import_module
+
+CONTEXT_HIT = "context_hit"
+PROCESS_HIT = "process_hit"
+MEMCACHE_HIT = "memcache_hit"
+MISS = "miss"
+FILL = "fill"
+EVICTION = "eviction"
+INVALIDATION = "invalidation"
+
+EVENTS = (CONTEXT_HIT, PROCESS_HIT, MEMCACHE_HIT, MISS, FILL, EVICTION, INVALIDATION)
+
+# A callable (or the dotted path to one) which is passed the CacheStats of each request when it finishes
+STATS_HOOK = getattr(settings, "DJANGAE_CACHE_STATS_HOOK", None)
+
+logger = logging.getLogger("djangae")
+
+_local = threading.local()
+_process_stats_lock = threading.Lock()
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.counts = {} # kind -> { event: count }
+        self.timings = {} # operation -> (calls, seconds)
+
+    def record(self, event, kind, count=1):
+        by_event = self.counts.setdefault(kind, {})
+        by_event[event] = by_event.get(event, 0) + count
+
+    def record_time(self, operation, seconds, calls=1):
+        previous_calls, previous_seconds = self.timings.get(operation, (0, 0.0))
+        self.timings[operation] = (previous_calls + calls, previous_seconds + seconds)
+
+    def merge(self, other):
+        for kind, by_event in other.counts.items():
+            for event, count in by_event.items():
+                self.record(event, kind, count)
+
+        for operation, (calls, seconds) in other.timings.items():
+            self.record_time(operation, seconds, calls)
+
+    def totals(self):
+        """
+            Returns a dictionary of event -> count across all kinds
+        """
+        totals = dict.fromkeys(EVENTS, 0)
+        for by_event in self.counts.values():
+            for event, count in by_event.items():
+                totals[event] = totals.get(event, 0) + count
+        return totals
+
+    def summary(self):
+        """
+            Returns a one line summary of the totals and timings, e.g. for a response header
+        """
+        totals = self.totals()
+        parts = [ "{}={}".format(x, totals[x]) for x in EVENTS ]
+        parts.extend(
+            "{}_ms={:.1f}".format(operation, seconds * 1000)
+            for operation, (calls, seconds) in sorted(self.timings.items())
+        )
+        return ", ".join(parts)
+
+    def __repr__(self):
+        return "<CacheStats: {}>".format(self.summary())
+
+
+_process_stats = CacheStats()
+
+
+def get_request_stats():
+    """
+        Returns the stats for the current request
+    """
+    if not hasattr(_local, "stats"):
+        _local.stats = CacheStats()
+    return _local.stats
+
+
+def get_process_stats():
+    """
+        Returns a copy of the stats for all the requests which have finished on this instance
+    """
+    with _process_stats_lock:
+        return copy.deepcopy(_process_stats)
+
+
+def record(event, kind, count=1):
+    get_request_stats().record(event, kind, count)
+
+
+def _get_timers():
+    """ Returns the timers which are running on this thread, innermost last """
+    if not hasattr(_local, "timers"):
+        _local.timers = []
+    return _local.timers
+
+
+class timed(object):
+    """
+        Context manager and decorator which records how long the code takes against
+        the named operation in the request's stats. Time spent in a nested timed operation
+        is only recorded against that operation, so the timings add up to the total time.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __call__(self, func):
+        @wraps(func)
+        def _wrapped(*args, **kwargs):
+            # A new instance each call, so that concurrent calls don't share the start time
+            with timed(self.operation):
+                return func(*args, **kwargs)
+        return _wrapped
+
+    def __enter__(self):
+        self.start = time.time()
+        self.nested_seconds = 0.0
+        _get_timers().append(self)
+
+    def __exit__(self, *args, **kwargs):
+        seconds = time.time() - self.start
+
+        timers = _get_timers()
+        timers.pop()
+        if timers:
+            timers[-1].nested_seconds += seconds
+
+        get_request_stats().record_time(self.operation, seconds - self.nested_seconds)
+
+
+def _get_stats_hook():
+    if isinstance(STATS_HOOK, basestring):
+        module, attr = STATS_HOOK.rsplit(".", 1)
+        return getattr(import_module(module), attr)
+    return STATS_HOOK
+
+
+@receiver(request_finished)
+def finish_request(*args, **kwargs):
+    """
+        Adds the request's stats to the process stats and passes them to the stats hook
+    """
+    from djangae.db.backends.appengine import caching
+
+    # This receiver can run before the caching layer's, so wait for the request's memcache
+    # calls here, otherwise the time spent waiting for them at the end of the request is lost
+    caching.wait_for_memcache_rpcs()
+
+    stats = get_request_stats()
+    del _local.stats
+
+    with _process_stats_lock:
+        _process_stats.merge(stats)
+
+    hook = _get_stats_hook()
+    if hook:
+        try:
+            hook(stats)
+        except Exception:
+            # A broken hook shouldn't break the request
+            logger.exception("Error calling the cache stats hook")
+
+
+@receiver(request_started)
+def start_request(*args, **kwargs):
+    if hasattr(_local, "stats"):
+        del _local.stats
@@ -1,15 +1,22 @@
 import logging
+import random
 import threading
+import time
+import zlib
+from hashlib import md5
 
 from google.appengine.api import datastore
+from google.appengine.api import memcache
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.signals import request_finished, request_started
 from django.dispatch import receiver
 from djangae.db import utils
+from djangae.indexing import special_indexes_for_model, special_indexes_version
 from djangae.db.unique_utils import unique_identifiers_from_entity, _format_value_for_identifier
-from djangae.db.backends.appengine.context import ContextStack
+from djangae.db.backends.appengine import cache_stats
+from djangae.db.backends.appengine.context import ContextStack, ProcessCache, MissingEntity, MISSING_ENTITY
 
 logger = logging.getLogger("djangae")
 
@@ -17,6 +24,47 @@ _context = threading.local()
 
 CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_TIMEOUT_SECONDS", 60 * 60)
 CACHE_ENABLED = getattr(settings, "DJANGAE_CACHE_ENABLED", True)
+CACHE_VERSION = getattr(settings, "DJANGAE_CACHE_VERSION", None)
+# Encoded entities larger than this many bytes are compressed in memcache, None disables compression
+CACHE_COMPRESSION_THRESHOLD = getattr(settings, "DJANGAE_CACHE_COMPRESSION_THRESHOLD", 1024)
+CACHE_MISSING_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_MISSING_TIMEOUT_SECONDS", 10)
+CONTEXT_CACHE_MAX_ENTITIES = getattr(settings, "DJANGAE_CONTEXT_CACHE_MAX_ENTITIES", 10000)
+QUERY_CACHE_ENABLED = getattr(settings, "DJANGAE_QUERY_CACHE_ENABLED", False)
+QUERY_CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_QUERY_CACHE_TIMEOUT_SECONDS", 60)
+
+# Non-ancestor queries are eventually consistent, so for a short while after a write a query might
+# not reflect it. We don't cache query results during this window.
+QUERY_CACHE_SETTLE_SECONDS = getattr(settings, "DJANGAE_QUERY_CACHE_SETTLE_SECONDS", 2)
+
+# When a request misses in memcache it takes a short lease on the key, other requests which miss while
+# it's held wait up to CACHE_LEASE_WAIT_SECONDS for the holder to fill it before going to the datastore
+CACHE_LEASE_SECONDS = getattr(settings, "DJANGAE_CACHE_LEASE_SECONDS", 2)
+CACHE_LEASE_WAIT_SECONDS = getattr(settings, "DJANGAE_CACHE_LEASE_WAIT_SECONDS", 0.1)
+
+# Asynchronous memcache calls are normally finished before the next read or at the end of the request. A task
+# which only writes would otherwise hold on to every call (and the values it sent) until it finished
+MAX_PENDING_MEMCACHE_RPCS = 100
+
+# Datastore cursors for the end of sliced queries are kept in memcache, so that a later slice starting
+# where that one ended can continue from the cursor rather than skipping an offset. Writes in the meantime
+# can shift results across the cursor, so this is off by default
+QUERY_CURSOR_CACHE_ENABLED = getattr(settings, "DJANGAE_QUERY_CURSOR_CACHE_ENABLED", False)
+QUERY_CURSOR_CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_QUERY_CURSOR_CACHE_TIMEOUT_SECONDS", 10 * 60)
+
+# The process cache sits between the context and memcache, and is shared by all requests on the instance
+PROCESS_CACHE_ENABLED = getattr(settings, "DJANGAE_PROCESS_CACHE_ENABLED", False)
+PROCESS_CACHE_MAX_ENTITIES = getattr(settings, "DJANGAE_PROCESS_CACHE_MAX_ENTITIES", 1000)
+
+_process_cache = ProcessCache(PROCESS_CACHE_MAX_ENTITIES)
+
+# Entities used to be cached as they are, under their identifiers. Values in the current format (stamped
+# tuples, encoded entities, pointers and leases) are stored under prefixed keys instead, so that during a
+# rolling deploy instances running the old code never read them (and we never read theirs).
+MEMCACHE_KEY_PREFIX = "_djangae_v2|"
+
+# While instances running the old code might still be serving requests, writes also delete what those
+# instances may have cached under the unprefixed identifiers. This can be turned off once they're all gone.
+CACHE_DELETE_UNPREFIXED_KEYS = getattr(settings, "DJANGAE_CACHE_DELETE_UNPREFIXED_KEYS", True)
 
 
 class CachingSituation:
@@ -25,14 +73,406 @@ class CachingSituation:
     DATASTORE_GET_PUT = 2 # When we are doing an update
 
 
+class Lease(object):
+    """
+        Stored in memcache in place of an entity while the request which missed refills it. Only
+        the holder of the lease can replace it (using compare-and-set), and invalidations delete it,
+        so an invalidation always wins over a fill which is still in flight.
+    """
+    def __init__(self, token):
+        self.token = token
+
+
+def _get_model_caching_option(model, name, default):
+    """
+        Returns an option from the model's Djangae options class. Entities are cached by
+        kind, so the options are read from the top concrete parent.
+    """
+    opts = getattr(utils.get_top_concrete_parent(model), "Djangae", None)
+    return getattr(opts, name, default)
+
+
+def _memcache_enabled_for_model(model):
+    return not _get_model_caching_option(model, "disable_memcache", False)
+
+
+def _context_enabled_for_model(model):
+    return not _get_model_caching_option(model, "disable_context_cache", False)
+
+
+def _memcache_timeout_for_model(model):
+    return _get_model_caching_option(model, "memcache_timeout", CACHE_TIMEOUT_SECONDS)
+
+
 def ensure_context():
     _context.memcache_enabled = getattr(_context, "memcache_enabled", True)
     _context.context_enabled = getattr(_context, "context_enabled", True)
-    _context.stack = _context.stack if hasattr(_context, "stack") else ContextStack()
+    _context.stack = _context.stack if hasattr(_context, "stack") else ContextStack(max_entities=CONTEXT_CACHE_MAX_ENTITIES)
+    _context.pending_rpcs = getattr(_context, "pending_rpcs", [])
+    _context.pending_leases = getattr(_context, "pending_leases", [])
+    _context.leases = getattr(_context, "leases", {})
+    _context.generations = getattr(_context, "generations", {})
+
+
+def _memcache_client():
+    """
+        Returns the App Engine memcache client behind the Django cache, or None if
+        the cache backend isn't using one (in which case we can't make async calls)
+    """
+    client = getattr(cache, "_cache", None)
+    if hasattr(client, "delete_multi_async"):
+        return client
+    return None
+
+
+@cache_stats.timed("memcache_wait")
+def wait_for_memcache_rpcs():
+    """
+        Waits for any memcache calls (cache fills and invalidations) which were issued asynchronously
+        by the caching layer in this request. This happens automatically at the end of a request and before the caching layer
+        next reads from memcache.
+    """
+    ensure_context()
+
+    _resolve_leases()
+
+    while _context.pending_rpcs:
+        _context.pending_rpcs.pop(0).get_result()
+
+
+def _queue_memcache_rpc(rpc):
+    """
+        Adds an asynchronous memcache call to those finished by wait_for_memcache_rpcs(), which is
+        called straight away if more than MAX_PENDING_MEMCACHE_RPCS are waiting
+    """
+    ensure_context()
+
+    _context.pending_rpcs.append(rpc)
+    if len(_context.pending_rpcs) > MAX_PENDING_MEMCACHE_RPCS:
+        wait_for_memcache_rpcs()
+
+
+def _prefixed(cache_key):
+    """
+        Returns the key (before the Django cache's own prefix) that the value for the cache key is stored under
+    """
+    return MEMCACHE_KEY_PREFIX + cache_key
+
+
+def _unprefixed(identifiers):
+    """
+        Returns the identifiers which old instances may have cached entities under, if
+        CACHE_DELETE_UNPREFIXED_KEYS is enabled
+    """
+    if not CACHE_DELETE_UNPREFIXED_KEYS:
+        return []
+    return [ x for x in identifiers if not x.startswith("_djangae_") ]
+
+
+def _get_many_from_memcache_by_cache_keys(cache_keys):
+    """
+        Returns a dictionary of cache key -> the raw value stored in memcache for it, for the
+        cache keys which were found
+    """
+    found = cache.get_many([ _prefixed(x) for x in cache_keys ])
+    return { x: found[_prefixed(x)] for x in cache_keys if _prefixed(x) in found }
+
+
+def _delete_many_from_memcache_async(memcache_keys):
+    """
+        Deletes the keys (which must already be prefixed, or be unprefixed identifiers
+        of old instances) without waiting for the result
+    """
+    client = _memcache_client()
+    if client is None:
+        cache.delete_many(memcache_keys)
+        return
+
+    _queue_memcache_rpc(
+        client.delete_multi_async([ cache.make_key(x) for x in memcache_keys ])
+    )
+
+
+def _set_many_in_memcache_async(mapping, timeout):
+    """
+        Writes the values to memcache without waiting for the result, the RPC is finished at the end of
+        the request (or before the caching layer next reads from or deletes from memcache).
+    """
+    client = _memcache_client()
+    if client is None:
+        cache.set_many({ _prefixed(k): v for k, v in mapping.items() }, timeout=timeout)
+        return
+
+    _queue_memcache_rpc(
+        client.set_multi_async(
+            { cache.make_key(_prefixed(k)): v for k, v in mapping.items() },
+            time=cache._get_memcache_timeout(timeout)
+        )
+    )
+
+
+def _cas_client():
+    """
+        Returns a memcache client for compare-and-set calls. The client stores the state between
+        get_multi(for_cas=True) and cas_multi() so each thread needs its own.
+    """
+    ensure_context()
+
+    if not hasattr(_context, "cas_client"):
+        _context.cas_client = type(_memcache_client())()
+    return _context.cas_client
+
+
+def _acquire_leases(cache_keys):
+    """
+        Tries to take the lease on each of the cache keys (which must not be in memcache). This doesn't
+        wait for the result, so that it's in flight at the same time as the datastore Get which follows
+        the miss. The leases we got are recorded in the thread local context by _resolve_leases().
+    """
+    client = _memcache_client()
+    if client is None or not cache_keys:
+        return
+
+    ensure_context()
+
+    token = random.getrandbits(64)
+    memcache_keys = { cache.make_key(_prefixed(x)): x for x in cache_keys }
+    rpc = client.add_multi_async(
+        { k: Lease(token) for k in memcache_keys }, time=cache._get_memcache_timeout(CACHE_LEASE_SECONDS)
+    )
+    _context.pending_leases.append((rpc, token, memcache_keys))
+
+
+def _resolve_leases():
+    """
+        Waits for the leases we've asked for, and records the ones we got
+    """
+    while _context.pending_leases:
+        rpc, token, memcache_keys = _context.pending_leases.pop(0)
+        statuses = rpc.get_result() or {}
+        for memcache_key, cache_key in memcache_keys.items():
+            if statuses.get(memcache_key) == memcache.STORED:
+                _context.leases[cache_key] = token
+
+
+class _PendingFill(object):
+    """
+        Replaces our leases on some cache keys with their values, unless they've been deleted (or
+        replaced) since we took them. Anything in `others` is set alongside, but only if one of the
+        leases is replaced. The compare-and-set needs the current values first, so the fill is
+        queued with the other asynchronous memcache calls and get_result() finishes it off.
+    """
+    def __init__(self, leased, others, timeout, kind=None):
+        self.leased = leased
+        self.others = others
+        self.timeout = cache._get_memcache_timeout(timeout)
+        self.kind = kind
+
+        self.tokens = { x: _context.leases.pop(x) for x in leased }
+        self.memcache_keys = { cache.make_key(_prefixed(x)): x for x in leased }
+
+        # The client keeps the compare-and-set ids from the get for the cas call
+        self.client = _cas_client()
+        self.get_rpc = self.client.get_multi_async(self.memcache_keys.keys(), for_cas=True)
+
+    def get_result(self):
+        current = self.get_rpc.get_result()
+        held = [
+            cache_key for memcache_key, cache_key in self.memcache_keys.items()
+            if isinstance(current.get(memcache_key), Lease) and current[memcache_key].token == self.tokens[cache_key]
+        ]
+        if not held:
+            return
+
+        # The rest of the values are set before the leases are replaced, so an invalidation
+        # which beats us to the leases can see them (or we remove them ourselves below)
+        if self.others:
+            self.client.set_multi_async(
+                { cache.make_key(_prefixed(k)): v for k, v in self.others.items() }, time=self.timeout
+            ).get_result()
+
+        statuses = self.client.cas_multi_async(
+            { cache.make_key(_prefixed(x)): self.leased[x] for x in held }, time=self.timeout
+        ).get_result() or {}
+
+        if memcache.STORED in statuses.values():
+            if self.kind:
+                cache_stats.record(cache_stats.FILL, self.kind)
+        elif self.others:
+            self.client.delete_multi_async([ cache.make_key(_prefixed(x)) for x in self.others ]).get_result()
+
+
+def _fill_leases(values, timeout, others=None, kind=None):
+    """
+        Queues a _PendingFill for the cache keys in values which we hold the lease on, if there are any
+    """
+    ensure_context()
+    _resolve_leases()
+
+    leased = { k: v for k, v in values.items() if k in _context.leases }
+    if not leased:
+        return
+
+    others = { k: v for k, v in (others or {}).items() if k not in leased }
+    _queue_memcache_rpc(_PendingFill(leased, others, timeout, kind))
+
+
+_cache_versions = {} # table -> (special indexes version, cache version)
+
+
+def _get_cache_version(cache_key):
+    """
+        Returns the version which entities cached in memcache under the cache key are stamped with. This
+        is a fingerprint of the fields and special indexes of the model the key belongs to (and
+        settings.DJANGAE_CACHE_VERSION), so entities cached by a different version of the app are ignored.
+    """
+    table = _get_kind_from_cache_key(cache_key)
+
+    # Special indexes can be added while the app is running, which changes the fingerprint
+    indexes_version = special_indexes_version()
+
+    if _cache_versions.get(table, (None, None))[0] != indexes_version:
+        fingerprint = [CACHE_VERSION]
+
+        model = utils.get_model_from_db_table(table)
+        if model:
+            fingerprint.append(sorted((x.column, x.get_internal_type()) for x in model._meta.fields))
+            fingerprint.append(sorted((k, sorted(v)) for k, v in (special_indexes_for_model(model) or {}).items()))
+
+        _cache_versions[table] = (indexes_version, md5(repr(fingerprint)).hexdigest()[:8])
+
+    return _cache_versions[table][1]
+
+
+def _stamp(cache_key, value):
+    return (_get_cache_version(cache_key), value)
+
+
+def _unstamp(cache_key, value):
+    """
+        Returns the value which was stored with _stamp(), or None if it was stamped by a different
+        version. Leases and the lists of identifiers stored alongside entities are returned as they
+        are, anything else (e.g. an entity cached before values were stamped) is treated as a miss.
+    """
+    if isinstance(value, (Lease, list)):
+        return value
+
+    if not (isinstance(value, tuple) and len(value) == 2):
+        return None
+
+    version, value = value
+    return value if version == _get_cache_version(cache_key) else None
+
+
+# Entities are stored in memcache once, under the cache key of their datastore key, as protobuf
+# bytes. Their other identifiers hold a pointer to that cache key.
+_ENCODED_ENTITY = "e"
+_COMPRESSED_ENTITY = "z"
+_POINTER = "p"
+
+
+def _encode_entity(entity):
+    data = entity.ToPb().Encode()
+    if CACHE_COMPRESSION_THRESHOLD is not None and len(data) > CACHE_COMPRESSION_THRESHOLD:
+        return (_COMPRESSED_ENTITY, zlib.compress(data))
+    return (_ENCODED_ENTITY, data)
+
+
+def _decode_entity(value):
+    """
+        Returns the entity from a value stored with _encode_entity(), anything else
+        (e.g. a MissingEntity) is returned as it is
+    """
+    if not isinstance(value, tuple):
+        return value
+
+    kind, data = value
+    if kind == _COMPRESSED_ENTITY:
+        data = zlib.decompress(data)
+    return datastore.Entity.FromPb(data)
+
+
+def _is_pointer(value):
+    return isinstance(value, tuple) and value[0] == _POINTER
+
+
+def _get_memcache_values(entity, identifiers):
+    """
+        Returns a dictionary of cache key -> value to store in memcache for the entity. The
+        entity is encoded once, the identifiers point to it.
+    """
+    cache_key, _ = _get_cache_key_and_model_from_datastore_key(entity.key())
+
+    pointer = (_POINTER, cache_key)
+    values = { x: _stamp(x, pointer) for x in identifiers if x != cache_key }
+    values[cache_key] = _stamp(cache_key, _encode_entity(entity))
+    return values
+
+
+def _get_kind_from_cache_key(cache_key):
+    """
+        Returns the table the cache key (or unique identifier) belongs to, this is what stats are
+        broken down by
+    """
+    return cache_key.split("|", 1)[0]
+
+
+def _get_reverse_cache_key(cache_key):
+    """
+        Returns the memcache key which stores the list of identifiers an entity
+        was cached under, given the cache key of the entity's primary key
+    """
+    return "_djangae_identifiers|{}".format(cache_key)
 
 
 def _add_entity_to_memcache(model, entity, identifiers):
-    cache.set_many({ x: entity for x in identifiers}, timeout=CACHE_TIMEOUT_SECONDS)
+    cache_key, _ = _get_cache_key_and_model_from_datastore_key(entity.key())
+
+    to_set = _get_memcache_values(entity, identifiers)
+
+    # Store the identifiers alongside the entity, so that we can evict them all without reading the entity back
+    to_set[_get_reverse_cache_key(cache_key)] = identifiers
+    _set_many_in_memcache_async(to_set, _memcache_timeout_for_model(model))
+
+    # Old instances would otherwise keep serving what they cached before this write
+    legacy = _unprefixed(identifiers)
+    if legacy:
+        _delete_many_from_memcache_async(legacy)
+
+    cache_stats.record(cache_stats.FILL, _get_kind_from_cache_key(cache_key))
+
+
+@cache_stats.timed("memcache_fill")
+def _fill_memcache(model, entity, identifiers):
+    """
+        Caches an entity which was read from the datastore. This only happens if we hold the lease on
+        one of its identifiers (we were the request which missed), and if the entity was invalidated
+        since we took the lease then nothing is left cached. The fill is finished asynchronously.
+    """
+    client = _memcache_client()
+    if client is None:
+        # Leases need the App Engine memcache client
+        _add_entity_to_memcache(model, entity, identifiers)
+        return
+
+    cache_key, _ = _get_cache_key_and_model_from_datastore_key(entity.key())
+
+    values = _get_memcache_values(entity, identifiers)
+    others = dict(values)
+    others[_get_reverse_cache_key(cache_key)] = identifiers
+
+    _fill_leases(
+        values, _memcache_timeout_for_model(model), others=others, kind=_get_kind_from_cache_key(cache_key)
+    )
+
+
+def _add_missing_to_memcache(identifiers):
+    """
+        Records that the entities don't exist, but only for the identifiers we still hold the lease on.
+        Without a lease there's nothing to stop this landing after an invalidation (e.g. of a delete
+        followed by a put) and hiding the entity, so nothing is written.
+    """
+    _fill_leases({ x: _stamp(x, MISSING_ENTITY) for x in identifiers }, CACHE_MISSING_TIMEOUT_SECONDS)
 
 
 def _get_cache_key_and_model_from_datastore_key(key):
@@ -49,29 +489,204 @@ def _get_cache_key_and_model_from_datastore_key(key):
     return (cache_key, model)
 
 
-def _remove_entity_from_memcache_by_key(key):
+@cache_stats.timed("memcache_invalidate")
+def _remove_entities_from_memcache_by_keys(identifiers_by_key, wait=True):
     """
-        Note, if the key of the entity got evicted from the cache, it's possible that stale cache
-        entries would be left behind. Remember if you need pure atomicity then use disable_cache() or a
-        transaction.
+        Removes the entities from memcache using the lists of identifiers stored alongside them, this
+        doesn't depend on the entities themselves still being in memcache. Note, if a list of identifiers
+        got evicted from the cache, it's possible that stale cache entries would be left behind. Remember
+        if you need pure atomicity then use disable_cache() or a transaction.
+
+        identifiers_by_key is a dictionary of key -> additional identifiers to remove, this is so that
+        negative cache entries for identifiers the entity has only just gained are wiped out.
+
+        This makes one get_many and one delete_many call regardless of the number of keys. If wait is False
+        the delete is issued asynchronously.
     """
 
-    cache_key, model = _get_cache_key_and_model_from_datastore_key(key)
-    entity = cache.get(cache_key)
+    # A fill which is still in flight could otherwise land after the delete
+    wait_for_memcache_rpcs()
+
+    to_delete = set()
+    reverse_cache_keys = []
+
+    for key, identifiers in identifiers_by_key.items():
+        cache_key, _ = _get_cache_key_and_model_from_datastore_key(key)
+        reverse_cache_key = _get_reverse_cache_key(cache_key)
+        reverse_cache_keys.append(reverse_cache_key)
+
+        to_delete.update(identifiers)
+        to_delete.update([cache_key, reverse_cache_key])
+
+        cache_stats.record(cache_stats.INVALIDATION, key.kind())
+
+    for cached_identifiers in _get_many_from_memcache_by_cache_keys(reverse_cache_keys).values():
+        to_delete.update(cached_identifiers or [])
+
+    memcache_keys = [ _prefixed(x) for x in to_delete ] + _unprefixed(to_delete)
+    if wait:
+        cache.delete_many(memcache_keys)
+    else:
+        _delete_many_from_memcache_async(memcache_keys)
+
+
+def _remove_entity_from_memcache_by_key(key, identifiers=()):
+    _remove_entities_from_memcache_by_keys({ key: identifiers })
+
+
+@cache_stats.timed("memcache_get")
+def _get_many_from_memcache(cache_keys):
+    """
+        Returns a dictionary of cache key -> value for the cache keys which were found. If another request
+        holds the lease on a key we wait briefly for it to be filled, and we take the lease on any keys which
+        weren't found so that we can fill them after going to the datastore.
+    """
+    wait_for_memcache_rpcs()
+
+    found = _get_many_from_memcache_by_cache_keys(cache_keys)
+
+    # Anything cached by a different version of the app is removed, so that we can take the lease on it
+    stale = [ k for k, v in found.items() if v is not None and _unstamp(k, v) is None ]
+    if stale:
+        cache.delete_many([ _prefixed(x) for x in stale ])
+        for cache_key in stale:
+            del found[cache_key]
+
+    deadline = time.time() + CACHE_LEASE_WAIT_SECONDS
+    while True:
+        leased = [
+            k for k, v in found.items()
+            if isinstance(v, Lease) and _context.leases.get(k) != v.token
+        ]
+        if not leased or time.time() >= deadline:
+            break
+
+        time.sleep(0.01)
+        refreshed = _get_many_from_memcache_by_cache_keys(leased)
+        for cache_key in leased:
+            if _unstamp(cache_key, refreshed.get(cache_key)) is None:
+                del found[cache_key]
+            else:
+                found[cache_key] = refreshed[cache_key]
+
+    found = { k: _unstamp(k, v) for k, v in found.items() }
+
+    # Follow the pointers to the entities in a single call
+    pointers = { k: v[1] for k, v in found.items() if _is_pointer(v) }
+    targets = set(pointers.values()) - set(found)
+    if targets:
+        found.update({ k: _unstamp(k, v) for k, v in _get_many_from_memcache_by_cache_keys(list(targets)).items() })
+
+    dangling = []
+    for cache_key, target in pointers.items():
+        if target in found:
+            found[cache_key] = found[target]
+        else:
+            # The entity was evicted, remove the pointer so that we can take the lease on it
+            dangling.append(cache_key)
+            del found[cache_key]
 
-    if entity:
-        identifiers = unique_identifiers_from_entity(model, entity)
-        cache.delete_many(identifiers)
+    if dangling:
+        cache.delete_many([ _prefixed(x) for x in dangling ])
 
+    _acquire_leases([ x for x in cache_keys if x not in found ])
 
-def _get_entity_from_memcache(identifier):
-    return cache.get(identifier)
+    ret = {
+        k: _decode_entity(found[k]) for k in cache_keys
+        if found.get(k) is not None and not isinstance(found[k], Lease)
+    }
+
+    for cache_key in ret:
+        cache_stats.record(cache_stats.MEMCACHE_HIT, _get_kind_from_cache_key(cache_key))
+
+    return ret
+
+
+def _get_from_process_cache(model, identifier):
+    generation = _get_request_generation(model)
+    if generation is None:
+        return None
+
+    ret = _process_cache.get_entity(identifier, generation)
+    if ret is not None:
+        cache_stats.record(cache_stats.PROCESS_HIT, _get_kind_from_cache_key(identifier))
+    return ret
+
+
+def _add_to_process_cache(model, identifiers, entity):
+    # Only a generation which was read before the entity was can be used, otherwise
+    # we might miss a write which happened in between
+    generation = _get_request_generation(model, fetch=False)
+    if generation is None or is_missing(entity):
+        return
+
+    _process_cache.cache_entity(identifiers, entity, generation)
+
+
+def _get_entity_from_memcache(identifier, model=None):
+    """
+        Looks up the identifier in the process cache (if the model uses it) and then memcache. Anything
+        found in memcache is added to the process cache.
+    """
+    if model:
+        ret = _get_from_process_cache(model, identifier)
+        if ret is not None:
+            return ret
+
+        if not _memcache_enabled_for_model(model):
+            return None
+
+    ret = _get_many_from_memcache([identifier]).get(identifier)
+    if ret is not None and model:
+        _add_to_process_cache(model, [identifier], ret)
+
+    return ret
 
 
 def _get_entity_from_memcache_by_key(key):
     # We build the cache key for the ID of the instance
-    cache_key, _ = _get_cache_key_and_model_from_datastore_key(key)
-    return cache.get(cache_key)
+    cache_key, model = _get_cache_key_and_model_from_datastore_key(key)
+
+    ret = _get_from_process_cache(model, cache_key)
+    if ret is not None:
+        return ret
+
+    if not _memcache_enabled_for_model(model):
+        return None
+
+    ret = _get_many_from_memcache([cache_key]).get(cache_key)
+    if ret is not None:
+        _add_to_process_cache(model, [cache_key], ret)
+
+    return ret
+
+
+def _get_entities_from_memcache_by_keys(keys):
+    """
+        Looks up all the keys in the process cache and then the rest with a single memcache
+        RPC, returns a dictionary of datastore key -> entity for the ones which were found
+    """
+    ret = {}
+    cache_keys = {}
+    models = {}
+    for key in keys:
+        cache_key, model = _get_cache_key_and_model_from_datastore_key(key)
+
+        entity = _get_from_process_cache(model, cache_key)
+        if entity is not None:
+            ret[key] = entity
+        elif _memcache_enabled_for_model(model):
+            cache_keys[cache_key] = key
+            models[cache_key] = model
+
+    if not cache_keys:
+        return ret
+
+    for cache_key, entity in _get_many_from_memcache(cache_keys.keys()).items():
+        _add_to_process_cache(models[cache_key], [cache_key], entity)
+        ret[cache_keys[cache_key]] = entity
+
+    return ret
 
 
 def add_entity_to_cache(model, entity, situation):
@@ -85,19 +700,92 @@ def add_entity_to_cache(model, entity, situation):
     if situation == CachingSituation.DATASTORE_GET and datastore.IsInTransaction():
         return
 
+    # Models can opt out of either cache with their Djangae options
+    use_memcache = _memcache_enabled_for_model(model)
+
     if situation in (CachingSituation.DATASTORE_PUT, CachingSituation.DATASTORE_GET_PUT) and datastore.IsInTransaction():
         # We have to wipe the entity from memcache
-        if entity.key():
-            _remove_entity_from_memcache_by_key(entity.key())
+        if entity.key() and use_memcache:
+            _remove_entity_from_memcache_by_key(entity.key(), identifiers)
+
+    if _context_enabled_for_model(model):
+        _context.stack.top.cache_entity(identifiers, entity, situation)
 
-    _context.stack.top.cache_entity(identifiers, entity, situation)
+    if not use_memcache:
+        return
 
     # Only cache in memcache of we are doing a GET (outside a transaction) or PUT (outside a transaction)
     # the exception is GET_PUT - which we do in our own transaction so we have to ignore that!
     if (not datastore.IsInTransaction() and situation in (CachingSituation.DATASTORE_GET, CachingSituation.DATASTORE_PUT)) or \
             situation == CachingSituation.DATASTORE_GET_PUT:
 
-        _add_entity_to_memcache(model, entity, identifiers)
+        if situation == CachingSituation.DATASTORE_GET:
+            # A Get() can race with an invalidation, so we only cache it if we hold the lease
+            _fill_memcache(model, entity, identifiers)
+            _add_to_process_cache(model, identifiers, entity)
+        else:
+            _add_entity_to_memcache(model, entity, identifiers)
+
+
+def add_entity_to_context(model, entity):
+    """
+        Adds an entity which was found in memcache (or the datastore) to the context cache only
+    """
+    ensure_context()
+
+    if datastore.IsInTransaction() or not _context_enabled_for_model(model):
+        return
+
+    identifiers = unique_identifiers_from_entity(model, entity)
+    _context.stack.top.cache_entity(identifiers, entity, CachingSituation.DATASTORE_GET)
+
+
+def add_missing_entity_to_cache(model, unique_identifier):
+    """
+        Records that nothing has this unique identifier. Only call this once the miss has been
+        confirmed by a strongly consistent read (e.g. of the UniqueMarker for the identifier), and
+        if the lookup couldn't have been affected by any other filters.
+    """
+    ensure_context()
+
+    # Same as add_entity_to_cache, a read inside a transaction doesn't tell us anything
+    # about the current state of the datastore
+    if datastore.IsInTransaction():
+        return
+
+    if _context_enabled_for_model(model):
+        _context.stack.top.cache_missing([unique_identifier])
+
+    if _memcache_enabled_for_model(model):
+        _add_missing_to_memcache([unique_identifier])
+
+
+def add_missing_entity_to_cache_by_key(key):
+    """
+        Records that a datastore Get() returned nothing for this key. Only a strongly consistent
+        read like this can be cached, a query which returns nothing might not have seen a write yet.
+    """
+    ensure_context()
+
+    # Same as add_entity_to_cache, a read inside a transaction doesn't tell us anything
+    # about the current state of the datastore
+    if datastore.IsInTransaction():
+        return
+
+    cache_key, model = _get_cache_key_and_model_from_datastore_key(key)
+
+    if _context_enabled_for_model(model):
+        _context.stack.top.cache_missing([cache_key], key=key)
+
+    if _memcache_enabled_for_model(model):
+        _add_missing_to_memcache([cache_key])
+
+
+def is_missing(entity):
+    """
+        Returns True if the value returned from the cache means the entity is known not to exist
+    """
+    return isinstance(entity, MissingEntity)
 
 
 def remove_entity_from_cache(entity):
@@ -105,24 +793,37 @@ def remove_entity_from_cache(entity):
     remove_entity_from_cache_by_key(key)
 
 
-def remove_entity_from_cache_by_key(key, memcache_only=False):
+def remove_entity_from_cache_by_key(key, memcache_only=False, identifiers=()):
     """
         Removes an entity from all caches (both context and memcache)
-        or just memcache if specified
+        or just memcache if specified. Any additional identifiers passed are
+        removed from memcache as well.
     """
     ensure_context()
 
     if not memcache_only:
-        for identifier in _context.stack.top.reverse_cache.get(key, []):
-            if identifier in _context.stack.top.cache:
-                del _context.stack.top.cache[identifier]
+        _context.stack.top.remove_entity(key)
+
+    _remove_entity_from_memcache_by_key(key, identifiers)
+
+
+def remove_entities_from_memcache_by_keys(identifiers_by_key):
+    """
+        Removes a batch of entities from memcache (but not the context) with a single pair of memcache
+        calls, the delete is issued asynchronously. This is used when a transaction commits.
+
+        identifiers_by_key is a dictionary of key -> additional identifiers to remove
+    """
+    ensure_context()
 
-    _remove_entity_from_memcache_by_key(key)
+    if identifiers_by_key:
+        _remove_entities_from_memcache_by_keys(identifiers_by_key, wait=False)
 
 
 def get_from_cache_by_key(key):
     """
-        Return an entity from the context cache, falling back to memcache when possible
+        Return an entity from the context cache, falling back to memcache when possible. If
+        the entity is known not to exist, the returned value will pass is_missing()
     """
 
     ensure_context()
@@ -137,15 +838,56 @@ def get_from_cache_by_key(key):
         if ret is None and not datastore.IsInTransaction():
             if _context.memcache_enabled:
                 ret = _get_entity_from_memcache_by_key(key)
+        elif ret is not None:
+            cache_stats.record(cache_stats.CONTEXT_HIT, key.kind())
     elif _context.memcache_enabled and not datastore.IsInTransaction():
         ret = _get_entity_from_memcache_by_key(key)
 
+    if ret is None:
+        cache_stats.record(cache_stats.MISS, key.kind())
+
     return ret
 
 
-def get_from_cache(unique_identifier):
+def get_from_cache_by_keys(keys):
     """
-        Return an entity from the context cache, falling back to memcache when possible
+        Return a dictionary of key -> entity for all the keys we can find in the context
+        cache, falling back to a single batched memcache lookup for the rest. Keys which
+        aren't cached are left out of the result, keys which are known not to exist map
+        to a value which passes is_missing()
+    """
+
+    ensure_context()
+
+    if not CACHE_ENABLED:
+        return {}
+
+    ret = {}
+    if _context.context_enabled:
+        # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
+        for key in keys:
+            entity = _context.stack.top.get_entity_by_key(key)
+            if entity is not None:
+                cache_stats.record(cache_stats.CONTEXT_HIT, key.kind())
+                ret[key] = entity
+
+    if _context.memcache_enabled and not datastore.IsInTransaction():
+        remaining = [ x for x in keys if x not in ret ]
+        if remaining:
+            ret.update(_get_entities_from_memcache_by_keys(remaining))
+
+    for key in keys:
+        if key not in ret:
+            cache_stats.record(cache_stats.MISS, key.kind())
+
+    return ret
+
+
+def get_from_cache(unique_identifier, model=None):
+    """
+        Return an entity from the context cache, falling back to memcache when possible. If
+        the entity is known not to exist, the returned value will pass is_missing(). If the
+        model is passed, memcache isn't used if the model has opted out of it.
     """
 
     ensure_context()
@@ -159,13 +901,195 @@ def get_from_cache(unique_identifier):
         ret = _context.stack.top.get_entity(unique_identifier)
         if ret is None and not datastore.IsInTransaction():
             if _context.memcache_enabled:
-                ret = _get_entity_from_memcache(unique_identifier)
+                ret = _get_entity_from_memcache(unique_identifier, model)
+        elif ret is not None:
+            cache_stats.record(cache_stats.CONTEXT_HIT, _get_kind_from_cache_key(unique_identifier))
     elif _context.memcache_enabled and not datastore.IsInTransaction():
-        ret = _get_entity_from_memcache(unique_identifier)
+        ret = _get_entity_from_memcache(unique_identifier, model)
+
+    if ret is None:
+        cache_stats.record(cache_stats.MISS, _get_kind_from_cache_key(unique_identifier))
 
     return ret
 
 
+def query_cache_enabled(model):
+    """
+        Returns True if query results should be cached for the model. Results are cached
+        per kind, so this is read from the top concrete parent's Djangae options, falling back
+        to settings.DJANGAE_QUERY_CACHE_ENABLED
+    """
+    return bool(_get_model_caching_option(model, "cache_query_results", QUERY_CACHE_ENABLED))
+
+
+def _get_generation_cache_key(kind):
+    return "_djangae_generation|{}".format(kind)
+
+
+def _new_generation():
+    """
+        Generations are unique rather than incremented, so that if one is evicted from
+        memcache we can't end up reusing it. They start with the time in milliseconds so
+        that we can tell how recently the kind was written to.
+    """
+    return "{}-{:08x}".format(int(time.time() * 1000), random.getrandbits(32))
+
+
+def get_query_generation(model):
+    """
+        Returns the current generation for the model's kind, or None if query results can't be
+        cached right now (e.g. we're in a transaction, or the cache is disabled)
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED or not _context.memcache_enabled or datastore.IsInTransaction():
+        return None
+
+    if not query_cache_enabled(model):
+        return None
+
+    return _get_generation(utils.get_datastore_kind(model))
+
+
+def _get_generation(kind):
+    wait_for_memcache_rpcs()
+
+    cache_key = _get_generation_cache_key(kind)
+    generation = cache.get(cache_key)
+    if generation is None:
+        cache.add(cache_key, _new_generation(), timeout=CACHE_TIMEOUT_SECONDS)
+        generation = cache.get(cache_key)
+
+    return generation
+
+
+def process_cache_enabled(model):
+    """
+        Returns True if entities of the model should be kept in the process cache, this is read from
+        the top concrete parent's Djangae options, falling back to settings.DJANGAE_PROCESS_CACHE_ENABLED
+    """
+    return bool(_get_model_caching_option(model, "cache_in_process", PROCESS_CACHE_ENABLED))
+
+
+def _get_request_generation(model, fetch=True):
+    """
+        Returns the generation of the model's kind that the process cache should be checked against, or
+        None if it can't be used right now. The generation is read from memcache once per request (unless
+        fetch is False), so the process cache costs at most one memcache call per kind per request.
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED or not _context.memcache_enabled or datastore.IsInTransaction():
+        return None
+
+    if not process_cache_enabled(model):
+        return None
+
+    kind = utils.get_datastore_kind(model)
+    if kind not in _context.generations and fetch:
+        _context.generations[kind] = _get_generation(kind)
+
+    return _context.generations.get(kind)
+
+
+def bump_generations(kinds):
+    """
+        Invalidates all the cached query results, and process cache entries, for the given kinds
+    """
+    if not kinds:
+        return
+
+    # The new generation mustn't be visible before the invalidations of the entities
+    # which were written have finished, or another request could cache them against it
+    wait_for_memcache_rpcs()
+
+    generations = { x: _new_generation() for x in kinds }
+    cache.set_many(
+        { _get_generation_cache_key(k): v for k, v in generations.items() },
+        timeout=CACHE_TIMEOUT_SECONDS
+    )
+
+    # Make sure the rest of this request sees its own writes
+    for kind, generation in generations.items():
+        if kind in _context.generations:
+            _context.generations[kind] = generation
+
+
+def bump_generation(model):
+    """
+        Called whenever the model is written to. If we are in a transaction the generation
+        is bumped again when it commits, as queries run before then won't see the write.
+    """
+    if not (query_cache_enabled(model) or process_cache_enabled(model)):
+        return
+
+    ensure_context()
+
+    kind = utils.get_datastore_kind(model)
+    bump_generations([kind])
+
+    if datastore.IsInTransaction():
+        _context.stack.top.changed_kinds.add(kind)
+
+
+def _get_query_result_cache_key(model, plan, generation):
+    return "_djangae_query|{}|{}|{}".format(
+        utils.get_datastore_kind(model), md5(plan).hexdigest(), generation
+    )
+
+
+def get_query_result_from_cache(model, plan, generation):
+    """
+        Returns the cached result for the query plan (a string describing the query) at
+        the given generation, or None
+    """
+    return cache.get(_get_query_result_cache_key(model, plan, generation))
+
+
+def add_query_result_to_cache(model, plan, generation, result):
+    """
+        Caches the query result (keys only, or a count) against the generation which was read
+        *before* the query was run, unless the kind was written to too recently for the query to
+        have seen it
+    """
+    written_at = int(generation.split("-")[0])
+    if (time.time() * 1000) - written_at < QUERY_CACHE_SETTLE_SECONDS * 1000:
+        return
+
+    cache.set(_get_query_result_cache_key(model, plan, generation), result, timeout=QUERY_CACHE_TIMEOUT_SECONDS)
+
+
+def query_cursor_cache_enabled(model):
+    """
+        Returns True if the cursors of sliced queries on the model should be cached, this is read from
+        the top concrete parent's Djangae options, falling back to settings.DJANGAE_QUERY_CURSOR_CACHE_ENABLED
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED or not _context.memcache_enabled:
+        return False
+
+    return bool(_get_model_caching_option(model, "cache_query_cursors", QUERY_CURSOR_CACHE_ENABLED))
+
+
+def _get_query_cursor_cache_key(model, plan, offset):
+    return "_djangae_cursor|{}|{}|{}".format(
+        utils.get_datastore_kind(model), md5(plan).hexdigest(), offset
+    )
+
+
+def get_query_cursor_from_cache(model, plan, offset):
+    """
+        Returns the cursor (as a websafe string) for the position after the first `offset`
+        results of the query plan, or None
+    """
+    return cache.get(_get_query_cursor_cache_key(model, plan, offset))
+
+
+def add_query_cursor_to_cache(model, plan, offset, cursor):
+    cache.set(_get_query_cursor_cache_key(model, plan, offset), cursor, timeout=QUERY_CURSOR_CACHE_TIMEOUT_SECONDS)
+
+
 @receiver(request_finished)
 @receiver(request_started)
 def reset_context(keep_disabled_flags=False, *args, **kwargs):
@@ -178,7 +1102,10 @@ def reset_context(keep_disabled_flags=False, *args, **kwargs):
     memcache_enabled = getattr(_context, "memcache_enabled", True)
     context_enabled = getattr(_context, "context_enabled", True)
 
-    for attr in ("stack", "memcache_enabled", "context_enabled"):
+    # Don't leave any invalidations from this request in flight
+    wait_for_memcache_rpcs()
+
+    for attr in ("stack", "memcache_enabled", "context_enabled", "pending_rpcs", "pending_leases", "leases", "generations"):
         if hasattr(_context, attr):
             delattr(_context, attr)
 
@@ -1,10 +1,10 @@
 #STANDARD LIB
 from datetime import datetime
+import heapq
 import logging
 import copy
 import re
-from functools import partial
-from itertools import chain, groupby
+from itertools import chain, islice
 
 #LIBRARIES
 from django.db import DatabaseError
@@ -19,6 +19,7 @@ from django.db.models.sql.where import EmptyWhere
 from django.db.models.fields import AutoField
 from google.appengine.api import datastore, datastore_errors
 from google.appengine.api.datastore import Query
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import db
 
 #DJANGAE
@@ -276,14 +277,56 @@ def _convert_entity_based_on_query_options(entity, opts):
     return entity
 
 
+def _to_cursor(cursor):
+    """ Cursors are passed around as websafe strings, this converts one back for the datastore """
+    if isinstance(cursor, basestring):
+        return datastore_query.Cursor(urlsafe=cursor)
+    return cursor
+
+
 def _get_key(query):
     return query["__key__ ="]
 
+
+def _get_entities_by_keys(model, keys, cache_in_context=False):
+    """
+        Returns a dictionary of key -> entity for the keys which exist. The caches are
+        hit first (context, then a single memcache lookup for the rest) and anything that
+        wasn't cached is fetched with a single Get(). If cache_in_context is True then
+        entities found in memcache are added to the context cache too.
+    """
+    cached = caching.get_from_cache_by_keys(keys)
+    results = { k: v for k, v in cached.items() if not caching.is_missing(v) }
+
+    if cache_in_context:
+        for entity in results.values():
+            caching.add_entity_to_context(model, entity)
+
+    uncached = [ x for x in keys if x not in cached ]
+    if uncached:
+        for key, result in zip(uncached, datastore.Get(uncached)):
+            if result is None:
+                caching.add_missing_entity_to_cache_by_key(key)
+                continue
+            caching.add_entity_to_cache(model, result, caching.CachingSituation.DATASTORE_GET)
+            results[key] = result
+
+    return results
+
+
 class QueryByKeys(object):
     def __init__(self, model, queries, ordering):
         self.model = model
         self.queries = queries
-        self.queries_by_key = { a: list(b) for a, b in groupby(queries, lambda x: _get_key(x)) }
+        self.queries_by_key = {}
+        for query in queries:
+            # The same key can appear in branches which aren't next to each other
+            self.queries_by_key.setdefault(_get_key(query), []).append(query)
+
+        self.matchers_by_key = {
+            key: [ utils.QueryMatcher(x) for x in key_queries ]
+            for key, key_queries in self.queries_by_key.items()
+        }
         self.ordering = ordering
         self._Query__kind = queries[0]._Query__kind
 
@@ -293,28 +336,12 @@ class QueryByKeys(object):
         # FIXME: What if the query options differ?
         opts = self.queries[0]._Query__query_options
 
-        results = None
-
-        # If we have a single key lookup going on, just hit the cache
-        if len(self.queries_by_key) == 1:
-            keys = self.queries_by_key.keys()
-            ret = caching.get_from_cache_by_key(keys[0])
-            if ret is not None:
-                results = [ret]
-
-        # If there was nothing in the cache, or we had more than one key, then use Get()
-        if results is None:
-            keys = self.queries_by_key.keys()
-            results = datastore.Get(keys)
-            for result in results:
-                if result is None:
-                    continue
-                caching.add_entity_to_cache(self.model, result, caching.CachingSituation.DATASTORE_GET)
-            results = sorted((x for x in results if x is not None), cmp=partial(utils.django_ordering_comparison, self.ordering))
+        results = _get_entities_by_keys(self.model, self.queries_by_key.keys()).values()
+        results = sorted(results, key=utils.get_ordering_sort_key(self.ordering))
 
         results = [
             _convert_entity_based_on_query_options(x, opts)
-            for x in results if any([ utils.entity_matches_query(x, qry) for qry in self.queries_by_key[x.key()]])
+            for x in results if any(matches(x) for matches in self.matchers_by_key[x.key()])
         ]
 
         if offset:
@@ -329,6 +356,158 @@ class QueryByKeys(object):
         return len([ x for x in self.Run(limit, offset) ])
 
 
+class _MergeEntry(object):
+    """
+        The head of one of the queries being merged by ParallelMultiQuery. Entries compare
+        by the query ordering and then by key, which is how the datastore orders ties.
+    """
+    __slots__ = ("entity", "sort_key", "iterator")
+
+    def __init__(self, entity, sort_key, iterator):
+        self.entity = entity
+        self.sort_key = (sort_key(entity), entity.key())
+        self.iterator = iterator
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+
+class ParallelMultiQuery(datastore.MultiQuery):
+    """
+        A MultiQuery which starts all of its queries before reading from any of them, so that
+        they are in flight together, and then lazily merges the results in order. Entities
+        returned by more than one of the queries are only returned once.
+    """
+    def __init__(self, queries, ordering):
+        super(ParallelMultiQuery, self).__init__(queries, ordering)
+        self.queries = queries
+        self.ordering = ordering
+        self.sort_key = utils.get_ordering_sort_key(ordering)
+        self.projection = queries[0]._Query__query_options.projection
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        """
+            Any of the queries could provide the first results, so each of them has to return offset + limit
+            entities and the offset is skipped while merging. A deep offset is therefore read (and billed)
+            once for every query.
+        """
+        offset = offset or 0
+
+        # Running a query sends its first RPC asynchronously, so start them all before
+        # reading any results. Each query must return enough to fill the offset and limit
+        run_kwargs = dict(kwargs)
+        if limit is not None:
+            run_kwargs["limit"] = offset + limit
+        iterators = [ query.Run(**run_kwargs) for query in self.queries ]
+
+        return islice(self._merge(iterators), offset, None if limit is None else offset + limit)
+
+    def _merge(self, iterators):
+        heap = []
+        for iterator in iterators:
+            self._push_next(heap, iterator)
+
+        seen = set()
+        while heap:
+            entry = heapq.heappop(heap)
+            self._push_next(heap, entry.iterator)
+
+            entity = entry.entity
+            if self.projection:
+                # Projection queries return an entity for each value of a list property
+                dedupe_key = (entity.key(), frozenset(entity.iteritems()))
+            else:
+                dedupe_key = entity.key()
+
+            if dedupe_key in seen:
+                continue
+
+            seen.add(dedupe_key)
+            yield entity
+
+    def _push_next(self, heap, iterator):
+        for entity in iterator:
+            heapq.heappush(heap, _MergeEntry(entity, self.sort_key, iterator))
+            break
+
+    def Count(self, limit=None, offset=None):
+        if self.projection:
+            return len(list(self.Run(limit=limit, offset=offset)))
+
+        # We only need the distinct keys to count, and if each query returns offset + limit
+        # keys then either the union is big enough, or every query returned everything
+        offset = offset or 0
+        run_kwargs = {} if limit is None else { "limit": offset + limit }
+
+        iterators = []
+        for query in self.queries:
+            # The ordering must match Run(), it decides which keys a limited query returns and the
+            # datastore leaves out entities which don't have an ordered property
+            keys_query = Query(query._Query__kind, keys_only=True)
+            keys_query.update(query)
+            keys_query.Order(*self.ordering)
+            iterators.append(keys_query.Run(**run_kwargs))
+
+        keys = set()
+        for iterator in iterators:
+            keys.update(iterator)
+
+        count = max(len(keys) - offset, 0)
+        return count if limit is None else min(count, limit)
+
+
+class CachedQuery(object):
+    """
+        Wraps a datastore Query or MultiQuery so that the keys it returns (or its count) are
+        cached in memcache against the current generation of the kind. Any write to the kind
+        changes the generation so the cached results are never used again. Entities are loaded
+        back through the key cache.
+    """
+    def __init__(self, query, model, plan, keys_only):
+        self._query = query
+        self._model = model
+        self._plan = plan
+        self._keys_only = keys_only
+        self._matches = utils.QueryMatcher(query)
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        # We must read the generation before running the query, otherwise a write which
+        # happened in between would be missing from what we cache. Any batch options are
+        # passed on to the query when it's run
+        generation = caching.get_query_generation(self._model)
+        if generation is None:
+            return self._query.Run(limit=limit, offset=offset, **kwargs)
+
+        plan = self._plan + repr(("RUN", limit, offset))
+        keys = caching.get_query_result_from_cache(self._model, plan, generation)
+        if keys is not None:
+            if self._keys_only:
+                return iter(keys)
+
+            # The entities come back from the key cache, so make sure they still match the query
+            entities = _get_entities_by_keys(self._model, keys)
+            return iter([ entities[x] for x in keys if x in entities and self._matches(entities[x]) ])
+
+        results = list(self._query.Run(limit=limit, offset=offset, **kwargs))
+        caching.add_query_result_to_cache(
+            self._model, plan, generation,
+            [ x if isinstance(x, datastore.Key) else x.key() for x in results ]
+        )
+        return iter(results)
+
+    def Count(self, limit=None, offset=None):
+        generation = caching.get_query_generation(self._model)
+        if generation is None:
+            return self._query.Count(limit=limit, offset=offset)
+
+        plan = self._plan + repr(("COUNT", limit, offset))
+        count = caching.get_query_result_from_cache(self._model, plan, generation)
+        if count is None:
+            count = self._query.Count(limit=limit, offset=offset)
+            caching.add_query_result_to_cache(self._model, plan, generation, count)
+        return count
+
+
 class NoOpQuery(object):
     def Run(self, limit, offset):
         return []
@@ -346,33 +525,69 @@ class UniqueQuery(object):
         self._identifier = unique_identifier
         self._gae_query = gae_query
         self._model = model
+        self._matches = utils.QueryMatcher(gae_query)
 
     def Run(self, limit, offset):
         opts = self._gae_query._Query__query_options
         if opts.keys_only or opts.projection:
             return self._gae_query.Run(limit=limit, offset=offset)
 
-        ret = caching.get_from_cache(self._identifier)
-        if ret is not None and not utils.entity_matches_query(ret, self._gae_query):
+        ret = caching.get_from_cache(self._identifier, self._model)
+        if caching.is_missing(ret):
+            return iter([])
+
+        if ret is not None and not self._matches(ret):
             ret = None
 
         if ret is None:
             # We do a fast keys_only query to get the result
             keys_query = Query(self._gae_query._Query__kind, keys_only=True)
             keys_query.update(self._gae_query)
-            keys = keys_query.Run(limit=limit, offset=offset)
+            keys = list(keys_query.Run(limit=limit, offset=offset))
+
+            if not keys and not offset and self._filters_only_on_identifier() and self._combination_is_free():
+                # Nothing has this unique combination
+                caching.add_missing_entity_to_cache(self._model, self._identifier)
+                return iter([])
 
             # Do a consistent get so we don't cache stale data, and recheck the result matches the query
-            ret = [ x for x in datastore.Get(keys) if utils.entity_matches_query(x, self._gae_query) ]
+            ret = [ x for x in datastore.Get(keys) if x is not None and self._matches(x) ]
             if len(ret) == 1:
                 caching.add_entity_to_cache(self._model, ret[0], caching.CachingSituation.DATASTORE_GET)
             return iter(ret)
 
         return iter([ ret ])
 
+    def _filters_only_on_identifier(self):
+        """
+            Returns True if the query has no filters other than the unique combination, in which case
+            the query returning nothing means that the identifier doesn't exist
+        """
+        return len(self._gae_query.keys()) == len(self._identifier.split("|")) - 1
+
+    def _combination_is_free(self):
+        """
+            The keys query is eventually consistent, so it finding nothing doesn't mean that nothing has
+            the unique combination (it may have only just been given it). The UniqueMarker is acquired
+            before the entity is saved, so we Get it (which is strongly consistent) to confirm the miss.
+            Without constraint checks there are no markers, and there are never markers for combinations
+            which include the primary key, so those misses can't be confirmed.
+        """
+        if datastore.IsInTransaction() or not constraints.constraint_checks_enabled(self._model):
+            return False
+
+        if "|__key__:" in self._identifier:
+            return False
+
+        marker_key = datastore.Key.from_path(constraints.UniqueMarker.kind(), self._identifier)
+        return datastore.Get([marker_key])[0] is None
+
     def Count(self, limit, offset):
-        ret = caching.get_from_cache(self._identifier)
-        if ret is not None and not utils.entity_matches_query(ret, self._gae_query):
+        ret = caching.get_from_cache(self._identifier, self._model)
+        if caching.is_missing(ret):
+            return 0
+
+        if ret is not None and not self._matches(ret):
             ret = None
 
         if ret is None:
@@ -502,6 +717,16 @@ class SelectCommand(object):
 
         self.limits = (query.low_mark, query.high_mark)
         self.results_returned = 0
+        self._column_converters = None
+
+        # Set on querysets returned by djangae.db.cursors.starting_cursor() and using_batch()
+        self.starting_cursor = getattr(query, "starting_cursor", None)
+        self.wants_cursor = getattr(query, "wants_cursor", False)
+        self.end_cursor = None
+        self._cursor_cache_offset = None
+        self.batch_options = {
+            k: getattr(query, k) for k in ("batch_size", "prefetch_size") if getattr(query, k, None)
+        }
 
         opts = query.get_meta()
 
@@ -670,6 +895,14 @@ class SelectCommand(object):
             raise NotSupportedError(self.unsupported_query_message)
 
         self.gae_query = self._build_gae_query()
+        if hasattr(self.original_query, "end_cursor") and not isinstance(self.gae_query, NoOpQuery) and not self._supports_cursors():
+            message = self._get_cursor_unsupported_message()
+            if self.wants_cursor:
+                raise NotSupportedError(message)
+
+            # The queryset only has batch options, get_cursor() raises this if it's called
+            self.original_query.end_cursor_error = message
+
         self.results = None
         self.query_done = False
         self.aggregate_type = "count" if self.is_count else None
@@ -697,6 +930,19 @@ class SelectCommand(object):
             self.where
         )
 
+    def get_column_converters(self):
+        """
+            Returns a (column, converter) pair for each queried column, where the converter turns the
+            entity's value into the value Django expects. The converter is None for the __key__ column.
+        """
+        if self._column_converters is None:
+            ops = self.connection.ops
+            self._column_converters = tuple(
+                (col, None if col == "__key__" else ops.get_value_converter(get_field_from_column(self.model, col)))
+                for col in self.queried_fields
+            )
+        return self._column_converters
+
     def _set_db_table(self):
         """ Work out which Datastore kind we should actually be querying. This allows for poly
             models, i.e. non-abstract parent models which we support by storing all fields for
@@ -854,7 +1100,7 @@ class SelectCommand(object):
 
                         new_queries.append(qry)
 
-                    query = datastore.MultiQuery(new_queries, ordering)
+                    query = ParallelMultiQuery(new_queries, ordering)
                 else:
                     query = queries[0]
                     try:
@@ -867,16 +1113,104 @@ class SelectCommand(object):
             except datastore_errors.BadArgumentError as e:
                 raise NotSupportedError(e)
 
+        self.query_plan = self._get_query_plan(ordering)
+
+        DJANGAE_LOG.debug("Select query: {0}, {1}".format(self.model.__name__, self.where))
+
+        if self.wants_cursor:
+            # The cursor must be passed to (or read from) the datastore query, so we can't use the caches
+            return query
+
         # If the resulting query was unique, then wrap as a unique query which
         # will hit the cache first
         unique_identifier = query_is_unique(self.model, query)
         if unique_identifier:
             return UniqueQuery(unique_identifier, query, self.model)
 
-        DJANGAE_LOG.debug("Select query: {0}, {1}".format(self.model.__name__, self.where))
+        # Projection, distinct and extra select queries aren't cached, as we only store the
+        # keys and reload the entities
+        if not (self.projection or self.distinct or self.extra_select) and caching.query_cache_enabled(self.model):
+            return CachedQuery(query, self.model, self.query_plan, self.keys_only)
 
         return query
 
+    def _get_query_plan(self, ordering):
+        """
+            Returns a string which uniquely identifies the datastore query (or queries) this
+            command will run
+        """
+        return repr((
+            self.db_table,
+            self.model._meta.db_table,
+            self.where,
+            ordering,
+            self.keys_only,
+            self.projection,
+            self.distinct,
+        ))
+
+    def _supports_cursors(self):
+        """ Cursors are only available from a plain datastore query (not a MultiQuery, or one of our wrappers) """
+        return type(self.gae_query) is Query
+
+    def _get_cursor_unsupported_message(self):
+        if isinstance(self.gae_query, QueryByKeys):
+            return "Cursors can't be used with queries on the primary key, they are run as a datastore Get"
+        elif isinstance(self.gae_query, (UniqueQuery, CachedQuery)):
+            return "The results came from the cache, so there is no cursor. Use starting_cursor(queryset, None) to get one"
+        return "Cursors can only be used with queries which run as a single datastore query (no OR, IN or != filters)"
+
+    def _run_gae_query(self, limit, offset):
+        if not self._supports_cursors():
+            if isinstance(self.gae_query, (Query, CachedQuery)):
+                # A ParallelMultiQuery passes the batch options to each of its queries, and a CachedQuery
+                # to its query if the results weren't cached. Lookups by key or unique combination are a
+                # Get (or return at most one entity), so they have no batches
+                return self.gae_query.Run(limit=limit, offset=offset, **self.batch_options)
+            return self.gae_query.Run(limit=limit, offset=offset)
+
+        start_cursor = self.starting_cursor
+        if start_cursor is None and limit is not None and not (self.excluded_pks or self.distinct_on_field):
+            if caching.query_cursor_cache_enabled(self.model):
+                # Once the results run out we cache the cursor against how far through we got, if a
+                # previous slice finished where this one starts we can skip the offset
+                self._cursor_cache_offset = offset or 0
+                if offset:
+                    start_cursor = caching.get_query_cursor_from_cache(self.model, self.query_plan, offset)
+                    if start_cursor is not None:
+                        offset = None
+
+        kwargs = dict(self.batch_options)
+        if start_cursor is not None:
+            kwargs["start_cursor"] = _to_cursor(start_cursor)
+
+        return self.gae_query.Run(limit=limit, offset=offset, **kwargs)
+
+    def _finish_results(self):
+        """ Called when we've returned all of the results, records the cursor for where they ended """
+        wants_cursor = hasattr(self.original_query, "end_cursor") or self._cursor_cache_offset is not None
+        if self.end_cursor is not None or not wants_cursor or not self._supports_cursors():
+            return
+
+        try:
+            cursor = self.gae_query.GetCursor()
+        except AssertionError:
+            # The datastore didn't return a cursor with the last batch
+            return
+
+        if cursor is None:
+            return
+
+        self.end_cursor = cursor.urlsafe()
+
+        if hasattr(self.original_query, "end_cursor"):
+            self.original_query.end_cursor = self.end_cursor
+
+        if self._cursor_cache_offset is not None:
+            caching.add_query_cursor_to_cache(
+                self.model, self.query_plan, self._cursor_cache_offset + self.results_returned, self.end_cursor
+            )
+
     def _do_fetch(self):
         assert not self.results
 
@@ -906,12 +1240,14 @@ class SelectCommand(object):
 
     def _run_query(self, limit=None, start=None, aggregate_type=None):
         if aggregate_type is None:
-            results = self.gae_query.Run(limit=limit, offset=start)
+            results = self._run_gae_query(limit, start)
             if self.keys_only:
                 # If we did a keys_only query for performance, we need to wrap the result
                 results = convert_keys_to_entities(results)
 
         elif self.aggregate_type == "count":
+            if self.starting_cursor is not None and self._supports_cursors():
+                return self.gae_query.Count(limit=limit, offset=start, start_cursor=_to_cursor(self.starting_cursor))
             return self.gae_query.Count(limit=limit, offset=start)
         else:
             raise RuntimeError("Unsupported query type")
@@ -926,6 +1262,27 @@ class SelectCommand(object):
 
 
     def next_result(self):
+        try:
+            return self._next_result()
+        except StopIteration:
+            self._finish_results()
+            raise
+
+    def next_results(self, size):
+        """
+            Returns a list of up to `size` results, there are only fewer than that once the
+            results have run out
+        """
+        results = []
+        next_result = self._next_result
+        try:
+            for i in xrange(size):
+                results.append(next_result())
+        except StopIteration:
+            self._finish_results()
+        return results
+
+    def _next_result(self):
         if self.limits[1]:
             if self.results_returned >= self.limits[1] - (self.limits[0] or 0):
                 raise StopIteration()
@@ -1023,6 +1380,10 @@ class InsertCommand(object):
 
             was_in_transaction = datastore.IsInTransaction()
 
+            # We can cache if we weren't in a transaction before the little nested one below, otherwise
+            # we treat it like any other Put() inside a transaction
+            situation = caching.CachingSituation.DATASTORE_PUT if was_in_transaction else caching.CachingSituation.DATASTORE_GET_PUT
+
             for key, ent in zip(self.included_keys, self.entities):
                 @db.transactional
                 def txn():
@@ -1037,13 +1398,12 @@ class InsertCommand(object):
                     if not constraints.constraint_checks_enabled(self.model):
                         # Fast path, just insert
                         results.append(datastore.Put(ent))
+                        caching.add_entity_to_cache(self.model, ent, situation)
                     else:
                         markers = constraints.acquire(self.model, ent)
                         try:
                             results.append(datastore.Put(ent))
-                            if not was_in_transaction:
-                                # We can cache if we weren't in a transaction before this little nested one
-                                caching.add_entity_to_cache(self.model, ent, caching.CachingSituation.DATASTORE_GET_PUT)
+                            caching.add_entity_to_cache(self.model, ent, situation)
                         except:
                             # Make sure we delete any created markers before we re-raise
                             constraints.release_markers(markers)
@@ -1055,6 +1415,7 @@ class InsertCommand(object):
 
                 txn()
 
+            caching.bump_generation(self.model)
             return results
         else:
 
@@ -1063,6 +1424,7 @@ class InsertCommand(object):
                 results = datastore.Put(self.entities)
                 for entity in self.entities:
                     caching.add_entity_to_cache(self.model, entity, caching.CachingSituation.DATASTORE_PUT)
+                caching.bump_generation(self.model)
                 return results
             else:
                 markers = []
@@ -1084,6 +1446,7 @@ class InsertCommand(object):
                     ent.__key = k
                     constraints.update_instance_on_markers(ent, m)
 
+                caching.bump_generation(self.model)
                 return results
 
 
@@ -1116,6 +1479,7 @@ class DeleteCommand(object):
 
             caching.remove_entity_from_cache_by_key(entity.key())
         datastore.Delete(keys)
+        caching.bump_generation(self.select.model)
 
 
 class UpdateCommand(object):
@@ -1187,4 +1551,7 @@ class UpdateCommand(object):
                 # Only increment the count if we successfully updated
                 i += 1
 
+        if i:
+            caching.bump_generation(self.model)
+
         return i
@@ -1,28 +1,131 @@
 import copy
 import collections
+import threading
 
 from google.appengine.api import datastore
 
-class CopyDict(collections.MutableMapping):
+from djangae.db.backends.appengine import cache_stats
+
+class CopyOnWriteEntity(collections.MutableMapping):
+    """
+        A cheap view over an entity snapshot stored in the context cache. Many
+        views (and many identifiers) share the same snapshot, which is never altered.
+        The first write to a view takes a private shallow copy of the snapshot and
+        from then on the view reads and writes that instead.
+
+        Mutable values (lists) are copied as they are read so that callers can't
+        alter the snapshot through them.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._entity = None
+
+    @property
+    def _current(self):
+        return self._snapshot if self._entity is None else self._entity
+
+    def _writable(self):
+        if self._entity is None:
+            self._entity = copy.copy(self._snapshot)
+        return self._entity
+
+    def __getitem__(self, key):
+        value = self._current[key]
+        if isinstance(value, list):
+            value = value[:]
+        return value
+
+    def __setitem__(self, key, value):
+        self._writable()[key] = value
+
+    def __delitem__(self, key):
+        del self._writable()[key]
+
+    def __contains__(self, key):
+        return key in self._current
+
+    def __iter__(self):
+        return iter(self._current)
+
+    def __len__(self):
+        return len(self._current)
+
+    def __getattr__(self, attr):
+        # Anything that isn't part of the mapping interface (e.g. key(), kind()) is
+        # read from the underlying entity
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        return getattr(self._current, attr)
+
+    def __repr__(self):
+        return "<CopyOnWriteEntity: {}>".format(repr(self._current))
+
+
+class MissingEntity(object):
+    """
+        Cached in place of an entity when a lookup has shown that it doesn't exist. This
+        is pickled into memcache too, so check for it with isinstance() rather than identity
+    """
+
+    def __repr__(self):
+        return "<MissingEntity>"
+
+MISSING_ENTITY = MissingEntity()
+
+
+def freeze_entity(entity):
+    """
+        Returns a snapshot of the entity suitable for sharing between cache entries. If
+        the entity is an unaltered view over a snapshot then that snapshot is reused
+    """
+    if isinstance(entity, MissingEntity):
+        return entity
+    if isinstance(entity, CopyOnWriteEntity) and entity._entity is None:
+        return entity._snapshot
+    if isinstance(entity, CopyOnWriteEntity):
+        entity = entity._entity
+    return copy.deepcopy(entity)
+
+
+class SnapshotDict(collections.MutableMapping):
     """
         It's important we don't pass references around in and out
-        of the cache, so this just ensures we copy stuff going in, and
-        copy it going out!
+        of the cache. Values are frozen once going in, and come out as
+        copy-on-write views so reading doesn't need to copy anything.
+
+        If log_changes is True then the last change to each key is kept in `changes`
+        (the snapshot, or None if it was deleted) so they can be replayed elsewhere.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, log_changes=False):
         self._store = {}
-        super(CopyDict, self).__init__(*args, **kwargs)
+        self.changes = collections.OrderedDict() if log_changes else None
+
+    def _log(self, key, snapshot):
+        if self.changes is not None:
+            self.changes.pop(key, None)
+            self.changes[key] = snapshot
 
     def __setitem__(self, key, value):
-        value = copy.deepcopy(value)
-        self._store[key] = value
+        self.set_snapshot(key, freeze_entity(value))
+
+    def set_snapshot(self, key, snapshot):
+        """ Stores an already frozen snapshot without copying it again """
+        self._store[key] = snapshot
+        self._log(key, snapshot)
 
     def __getitem__(self, key):
-        value = self._store[key]
-        return copy.deepcopy(value)
+        snapshot = self._store[key]
+        if isinstance(snapshot, MissingEntity):
+            return snapshot
+        return CopyOnWriteEntity(snapshot)
 
     def __delitem__(self, key):
         del self._store[key]
+        self._log(key, None)
+
+    def __contains__(self, key):
+        return key in self._store
 
     def __iter__(self):
         return iter(self._store)
@@ -30,54 +133,238 @@ class CopyDict(collections.MutableMapping):
     def __len__(self):
         return len(self._store)
 
+
+class ProcessCache(object):
+    """
+        A size bounded LRU cache of entity snapshots which is shared by all the threads
+        (and so all the requests) on an instance. Each entry is stored with the generation
+        of its kind when it was cached, and is only returned while that's still the
+        current generation. The limit is on the number of entities, however many
+        identifiers each one is cached under.
+    """
+    def __init__(self, max_entities):
+        self.max_entities = max_entities
+        self._entries = {}  # Identifier -> (generation, snapshot)
+        self._lru = collections.OrderedDict()  # Entity key -> the identifiers it's cached under
+        self._lock = threading.Lock()
+
+    def _remove_identifier(self, identifier, key):
+        """ Removes the identifier if it's still cached against the entity with the given key """
+        entry = self._entries.get(identifier)
+        if entry is not None and entry[1].key() == key:
+            del self._entries[identifier]
+
+    def cache_entity(self, identifiers, entity, generation):
+        snapshot = freeze_entity(entity)
+        key = snapshot.key()
+
+        with self._lock:
+            for identifier in identifiers:
+                self._entries[identifier] = (generation, snapshot)
+
+            # An entity found by one of its identifiers is cached under just that, so keep the others
+            self._lru[key] = self._lru.pop(key, frozenset()) | frozenset(identifiers)
+
+            while len(self._lru) > self.max_entities:
+                oldest, oldest_identifiers = self._lru.popitem(last=False)
+                for identifier in oldest_identifiers:
+                    self._remove_identifier(identifier, oldest)
+                cache_stats.record(cache_stats.EVICTION, oldest.kind())
+
+    def get_entity(self, identifier, generation):
+        with self._lock:
+            entry = self._entries.get(identifier)
+            if entry is None:
+                return None
+
+            key = entry[1].key()
+            if entry[0] != generation:
+                # Anything from an old generation is stale, so it isn't kept
+                del self._entries[identifier]
+
+                remaining = self._lru.get(key, frozenset()) - frozenset([identifier])
+                if remaining:
+                    self._lru[key] = remaining
+                else:
+                    self._lru.pop(key, None)
+                return None
+
+            if key in self._lru:
+                self._lru[key] = self._lru.pop(key)
+
+        return CopyOnWriteEntity(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._lru.clear()
+
+    def __len__(self):
+        return len(self._lru)
+
+
 class Context(object):
 
-    def __init__(self, stack):
-        self.cache = CopyDict()
-        self.reverse_cache = CopyDict()
+    def __init__(self, stack, max_entities=None, log_changes=False):
+        """
+            max_entities: the maximum number of entities (or missing entity markers) to hold, the
+            least recently used are evicted beyond this. None means unbounded.
+
+            log_changes: record what is cached and removed so that apply() can replay just those
+            changes on to another context, rather than comparing the whole of both.
+        """
+        self.cache = SnapshotDict(log_changes=log_changes)
+        self.reverse_cache = {}
+        self.removed_keys = {} if log_changes else None  # Key -> the identifiers it was cached under
+        self.changed_kinds = set()  # Kinds with cached query results which were written to
+        self.max_entities = max_entities
+        self._lru = collections.OrderedDict()
         self._stack = stack
 
+    def _touch(self, token):
+        """
+            Marks the entity key (or identifier, for missing entity markers which don't have one)
+            as the most recently used, evicting the least recently used if we're over the limit. The
+            order is kept even if we're unbounded, so that it can be applied to a context which isn't.
+        """
+        self._lru.pop(token, None)
+        self._lru[token] = True
+
+        while self.max_entities is not None and len(self._lru) > self.max_entities:
+            oldest, _ = self._lru.popitem(last=False)
+            self._evict(oldest)
+
+    def _bump(self, token):
+        if token in self._lru:
+            self._touch(token)
+
+    def _is_cached(self, token):
+        """ Returns True if the LRU token is for an entity key, or missing entity marker, we still hold """
+        if isinstance(token, datastore.Key):
+            return token in self.reverse_cache
+        return isinstance(self.cache._store.get(token), MissingEntity)
+
+    def _owns(self, identifier, key):
+        """ Returns True if the identifier is cached against the entity with the given key """
+        snapshot = self.cache._store.get(identifier)
+        if snapshot is None:
+            return False
+        if isinstance(snapshot, MissingEntity):
+            return True
+        return snapshot.key() == key
+
+    def _evict(self, token):
+        if isinstance(token, datastore.Key):
+            cache_stats.record(cache_stats.EVICTION, token.kind())
+
+            for identifier in self.reverse_cache.pop(token, ()):
+                if self._owns(identifier, token):
+                    del self.cache[identifier]
+        elif isinstance(self.cache._store.get(token), MissingEntity):
+            del self.cache[token]
+
     def apply(self, other):
-        self.cache.update(other.cache)
+        """
+            Replays the changes logged by the other context (which must have been created
+            with log_changes=True) on to this one. This only touches what the other
+            context changed, however much this one holds.
+        """
+        # Removals first, the other context may have removed an entity and then cached it again
+        for key, identifiers in other.removed_keys.items():
+            self.remove_entity(key)
+            if self.removed_keys is not None:
+                self.removed_keys[key].update(identifiers)
+
+        for identifier, snapshot in other.cache.changes.items():
+            # Snapshots are never altered, so they can be shared with the other context
+            if snapshot is not None:
+                self.cache.set_snapshot(identifier, snapshot)
+            elif identifier in self.cache:
+                del self.cache[identifier]
+
+        for key, identifiers in other.reverse_cache.items():
+            # Drop anything we have cached against identifiers the entity no longer has
+            for identifier in set(self.reverse_cache.get(key, ())) - set(identifiers):
+                if self._owns(identifier, key):
+                    del self.cache[identifier]
+
+            self.reverse_cache[key] = identifiers
+
+        # What the other context used most recently is now the most recently used here, apart
+        # from anything it removed
+        for token in other._lru:
+            if self._is_cached(token):
+                self._touch(token)
 
-        # We have to delete things that don't exist in the other
-        for k in self.cache.keys():
-            if k not in other.cache:
-                del self.cache[k]
+    def cache_entity(self, identifiers, entity, situation):
+        assert hasattr(identifiers, "__iter__")
 
-        self.reverse_cache.update(other.reverse_cache)
+        key = entity.key()
 
-        # We have to delete things that don't exist in the other
-        for k in self.reverse_cache.keys():
-            if k not in other.reverse_cache:
-                del self.reverse_cache[k]
+        # If the entity was cached before under identifiers that it no longer has (e.g. a
+        # unique field changed) then remove those, otherwise they'd return stale data
+        for identifier in set(self.reverse_cache.get(key, ())) - set(identifiers):
+            if self._owns(identifier, key):
+                del self.cache[identifier]
 
-    def cache_entity(self, identifiers, entity, situation):
-        assert hasattr(identifiers, "__iter__")
+        # Take a single snapshot, and point all the identifiers at it
+        snapshot = freeze_entity(entity)
+        for identifier in identifiers:
+            self.cache.set_snapshot(identifier, snapshot)
 
+        self.reverse_cache[key] = tuple(identifiers)
+        self._touch(key)
+
+    def cache_missing(self, identifiers, key=None):
+        """
+            Records that there is no entity for the identifiers (and optionally the key). This
+            never replaces an entity which is already cached.
+        """
         for identifier in identifiers:
-            self.cache[identifier] = copy.deepcopy(entity)
+            if identifier not in self.cache:
+                self.cache.set_snapshot(identifier, MISSING_ENTITY)
+                if key is None:
+                    self._touch(identifier)
 
-        self.reverse_cache[entity.key()] = identifiers
+        if key is not None and self.get_entity_by_key(key) is None:
+            self.reverse_cache[key] = tuple(identifiers)
+            self._touch(key)
 
     def remove_entity(self, entity_or_key):
-        if not isinstance(entity_or_key, datastore.Key):
-            entity_or_key = entity_or_key.key()
+        """
+            Removes the entity, and the identifiers it was cached under, from the context. A
+            transaction context remembers the identifiers in removed_keys so that they're still
+            invalidated in memcache when it commits.
+        """
+        key = entity_or_key if isinstance(entity_or_key, datastore.Key) else entity_or_key.key()
+
+        identifiers = self.reverse_cache.pop(key, ())
+        for identifier in identifiers:
+            if self._owns(identifier, key):
+                del self.cache[identifier]
 
-        for identifier in self.reverse_cache[entity_or_key]:
-            del self.cache[identifier]
+        self._lru.pop(key, None)
 
-        del self.reverse_cache[entity_or_key]
+        if self.removed_keys is not None:
+            # The entity may be cached in the context we're applied to, even if not in this one
+            self.removed_keys.setdefault(key, set()).update(identifiers)
 
     def get_entity(self, identifier):
-        return self.cache.get(identifier)
+        ret = self.cache.get(identifier)
+        if ret is not None:
+            self._bump(identifier if isinstance(ret, MissingEntity) else ret.key())
+        return ret
 
     def get_entity_by_key(self, key):
         try:
             identifier = self.reverse_cache[key][0]
-        except KeyError:
+        except (KeyError, IndexError):
             return None
-        return self.get_entity(identifier)
+
+        ret = self.cache.get(identifier)
+        if ret is not None:
+            self._bump(key)
+        return ret
 
 
 class ContextStack(object):
@@ -86,13 +373,18 @@ class ContextStack(object):
         caches for multi level transactions.
     """
 
-    def __init__(self):
-        self.stack = [ Context(self) ]
+    def __init__(self, max_entities=None):
+        self.max_entities = max_entities
+        self.stack = [ Context(self, max_entities=max_entities) ]
         self.staged = []
 
     def push(self):
+        # Transaction contexts are never bounded. If an entity written earlier in the transaction
+        # was evicted then reading it again would go to the datastore, which returns what it was
+        # before the transaction, so the transaction wouldn't see its own write.
         self.stack.append(
-            Context(self) # Empty context
+            # Empty context
+            Context(self, log_changes=True)
         )
 
     def pop(self, apply_staged=False, clear_staged=False, discard=False):
@@ -117,13 +409,24 @@ class ContextStack(object):
             self.stack.pop()
 
         if apply_staged:
+            # Gather up everything touched by the staged contexts, so we can invalidate
+            # it in memcache in one go
+            to_invalidate = {}
+            changed_kinds = set()
             while self.staged:
                 to_apply = self.staged.pop()
-                for key in to_apply.reverse_cache.keys():
-                    caching.remove_entity_from_cache_by_key(key, memcache_only=True)
+                for key, identifiers in to_apply.reverse_cache.items():
+                    to_invalidate.setdefault(key, set()).update(identifiers)
 
+                for key, identifiers in to_apply.removed_keys.items():
+                    to_invalidate.setdefault(key, set()).update(identifiers)
+
+                changed_kinds.update(to_apply.changed_kinds)
                 self.top.apply(to_apply)
 
+            caching.remove_entities_from_memcache_by_keys(to_invalidate)
+            caching.bump_generations(changed_kinds)
+
         if clear_staged or len(self.stack) == 1:
             self.staged = []
 
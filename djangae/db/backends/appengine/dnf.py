@@ -1,3 +1,5 @@
+import collections
+import threading
 from itertools import  product
 from django.db.models.sql.where import Constraint
 from commands import parse_constraint, OPERATORS_MAP
@@ -17,6 +19,17 @@ except ImportError:
 
 IMPOSSIBLE_FILTER = ('__key__', '<', datastore.Key.from_path('', 1))
 
+# The normalised trees of recently parsed queries, keyed on the parsed tree with the literal
+# values replaced by placeholders, so queries with the same shape only need their values binding
+NORMALISED_CACHE_MAX_ENTRIES = 1000
+
+# Trees with more literals than this aren't cached. These are mostly lookups of long lists of keys,
+# which rarely repeat with the same length, and would make each entry of the cache very large
+NORMALISED_CACHE_MAX_LITERALS = 30
+
+_normalised_cache = collections.OrderedDict()
+_normalised_cache_lock = threading.Lock()
+
 class QueryContainsOR(Exception):
     pass
 
@@ -201,6 +214,102 @@ def process_node(node, connection, negated=False):
     return (node.connector, [child for child in node.children]), negated, False
 
 
+def _template(node, values):
+    """
+        Returns a copy of the parsed tree with each literal value replaced by its
+        index in values (which the values are appended to)
+    """
+    if node[0] == 'LIT':
+        if node[1] == IMPOSSIBLE_FILTER:
+            return node
+
+        column, op, value = node[1]
+        values.append(value)
+        return ('LIT', (column, op, len(values) - 1))
+
+    return (node[0], [ _template(x, values) for x in node[1] ])
+
+
+def _freeze(node):
+    if node[0] == 'LIT':
+        return node
+    return (node[0], tuple(_freeze(x) for x in node[1]))
+
+
+def _bind(node, values):
+    """ The opposite of _template, puts the values back in place of their indexes """
+    if node[0] == 'LIT':
+        if node[1] == IMPOSSIBLE_FILTER:
+            return node
+
+        column, op, index = node[1]
+        return ('LIT', (column, op, values[index]))
+
+    return (node[0], [ _bind(x, values) for x in node[1] ])
+
+
+def _normalise(tree):
+    """
+        Applies DNF to the parsed tree and removes the impossible branches. Returns None if
+        every branch was impossible
+    """
+    tree = tripled(tree)
+
+    if tree[0] != 'OR':
+        tree = ('OR', [tree])
+
+    final = []
+    for and_branch in tree[-1]:
+        if and_branch[0] == 'LIT' and and_branch[-1] == IMPOSSIBLE_FILTER:
+            continue
+        elif and_branch[0] == 'AND' and IMPOSSIBLE_FILTER in [x[-1] for x in and_branch[-1] ]:
+            continue
+
+        final.append(and_branch)
+
+    return (tree[0], final) if final else None
+
+
+def _get_normalised(tree):
+    """
+        Returns the normalised form of the parsed tree, reusing the normalised form of any
+        recent tree with the same shape (the same literals, apart from their values)
+    """
+    values = []
+    template = _template(tree, values)
+
+    if len(values) > NORMALISED_CACHE_MAX_LITERALS:
+        normalised = _normalise(template)
+        return None if normalised is None else _bind(normalised, values)
+
+    cache_key = _freeze(template)
+
+    # The lock is only held to read and update the cache, normalising can take a while and
+    # other threads shouldn't wait on it. Two threads may normalise the same shape at once,
+    # which is harmless as they produce the same result.
+    with _normalised_cache_lock:
+        try:
+            normalised = _normalised_cache.pop(cache_key)
+            found = True
+        except KeyError:
+            found = False
+        else:
+            _normalised_cache[cache_key] = normalised
+
+    if not found:
+        normalised = _normalise(template)
+
+        with _normalised_cache_lock:
+            _normalised_cache[cache_key] = normalised
+            while len(_normalised_cache) > NORMALISED_CACHE_MAX_ENTRIES:
+                _normalised_cache.popitem(last=False)
+
+    if normalised is None:
+        return None
+
+    return _bind(normalised, values)
+
+
 def parse_dnf(node, connection, ordering=None):
     should_in_memory_exclude = should_exclude_pks_in_memory(node, ordering)
 
@@ -212,40 +321,19 @@ def parse_dnf(node, connection, ordering=None):
     if not should_exclude_pks_in_memory:
         assert excluded_pks is None
 
-    if tree:
-        tree = tripled(tree)
-
-
-    if tree and tree[0] != 'OR':
-        tree = ('OR', [tree])
-
-
     # Filter out impossible branches of the where, if that then results in an empty tree then
     # raise an EmptyResultSet, otherwise replace the tree with the now simpler query
     if tree:
-        final = []
-        for and_branch in tree[-1]:
-            if and_branch[0] == 'LIT' and and_branch[-1] == IMPOSSIBLE_FILTER:
-                continue
-            elif and_branch[0] == 'AND' and IMPOSSIBLE_FILTER in [x[-1] for x in and_branch[-1] ]:
-                continue
-
-            final.append(and_branch)
-        if not final:
+        tree = _get_normalised(tree)
+        if not tree:
             raise EmptyResultSet()
-        else:
-            tree = (tree[0], final)
 
-    # If there are more than 30 filters, and not all filters are PK filters
+    # If there are more than 30 filters, the query can only be run if every branch looks up a key, in
+    # which case the keys are fetched with a Get and any other filters are applied in memory
     if tree and len(tree[-1]) > 30:
         for and_branch in tree[-1]:
-            if and_branch[0] == 'LIT':
-                and_branch = [and_branch]
-            for lit in and_branch[-1] if and_branch[0] == 'AND' else and_branch:  # Go through each literal tuple
-                if isinstance(lit[-1], datastore.Key) or isinstance(lit[-1][-1], datastore.Key):  # If the value is a key, then break the loop
-                    break
-            else:
-                # If we didn't find a literal with a datastore Key, then raise unsupported
+            lits = [ and_branch ] if and_branch[0] == 'LIT' else and_branch[-1]
+            if not any(op == '=' and isinstance(value, datastore.Key) for column, op, value in (x[-1] for x in lits)):
                 raise NotSupportedError("The datastore doesn't support this query, more than 30 filters were needed")
 
     return tree, filtered_columns, excluded_pks or set()
@@ -1,5 +1,7 @@
 from google.appengine.api import datastore
+from django.db import connections, router
 
+from djangae.db import utils
 from djangae.db.backends.appengine import caching, context
 
 
@@ -58,4 +60,42 @@ def clear_context_cache():
     if datastore.IsInTransaction():
         raise RuntimeError("Clearing the context cache inside a transaction breaks everything, we can't let you do that")
 
-    caching._context.stack = context.ContextStack()
+    caching._context.stack = context.ContextStack(max_entities=caching.CONTEXT_CACHE_MAX_ENTITIES)
+
+
+def clear_process_cache():
+    """
+        Empties the process cache on this instance. Entries are invalidated by writes anyway,
+        this is really only useful for testing.
+    """
+    caching._process_cache.clear()
+
+
+def prefetch(model, pks):
+    """
+        Loads the instances of the model with the given primary keys into the context cache, so
+        that subsequent lookups by pk are served from memory. This makes a single memcache call
+        and a single datastore Get() for whatever isn't already in the context.
+
+        Inside a transaction reads don't come from the cache, so prefetching would do nothing,
+        we raise rather than let you think otherwise.
+    """
+    # commands imports this module, so we can't import it at the top
+    from djangae.db.backends.appengine.commands import _get_entities_by_keys
+
+    if datastore.IsInTransaction():
+        raise RuntimeError("Prefetching inside a transaction does nothing, the context cache isn't read until it commits")
+
+    connection = connections[router.db_for_read(model)]
+    pk_field = model._meta.pk
+    keys = [ utils.get_datastore_key(model, pk_field.get_db_prep_value(x, connection)) for x in set(pks) ]
+    if keys:
+        _get_entities_by_keys(model, keys, cache_in_context=True)
+
+
+def prefetch_queryset(queryset):
+    """
+        Loads the instances matched by the queryset into the context cache. The queryset is run
+        as a keys only query, then the entities are fetched with prefetch().
+    """
+    prefetch(queryset.model, queryset.values_list("pk", flat=True))
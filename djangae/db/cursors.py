@@ -0,0 +1,120 @@
+"""
+    Control over how querysets iterate through the datastore.
+
+    Slicing a queryset uses a datastore offset, and the datastore still reads every entity it
+    skips, so to page deep into results pass the cursor from the end of one page to the query
+    for the next:
+
+        queryset = starting_cursor(MyModel.objects.order_by("name"), request.GET.get("cursor"))
+        page = queryset[:20]
+        ...
+        next_cursor = get_cursor(page)
+
+    Cursors can only be used with querysets which run as a single datastore query, so not with
+    OR, IN or != filters, or lookups by primary key (which are a datastore Get). Querysets which
+    ask for a cursor (with starting_cursor or get_cursor) are never served from the caches.
+
+    When iterating over a lot of results, using_batch(queryset, 500) sets how many results the
+    datastore returns in each batch.
+"""
+from django.db import NotSupportedError
+from django.db.models.sql.query import Query
+
+
+class DatastoreQueryMixin(object):
+    """
+        Mixed in to the class of a queryset's Query, so that the options for the datastore query
+        are kept when the queryset is cloned. The backend records the cursor where the results
+        ended in end_cursor, or why there isn't one in end_cursor_error.
+    """
+    starting_cursor = None
+    wants_cursor = False
+    batch_size = None
+    prefetch_size = None
+    end_cursor = None
+    end_cursor_error = None
+
+    def clone(self, *args, **kwargs):
+        obj = super(DatastoreQueryMixin, self).clone(*args, **kwargs)
+        if isinstance(obj, DatastoreQueryMixin):
+            # Update and delete queries are cloned to a different class, and don't take the options
+            obj.starting_cursor = self.starting_cursor
+            obj.wants_cursor = self.wants_cursor
+            obj.batch_size = self.batch_size
+            obj.prefetch_size = self.prefetch_size
+        return obj
+
+
+class DatastoreQuery(DatastoreQueryMixin, Query):
+    """ The class of a plain queryset's Query once it carries datastore options """
+
+
+# Base query class -> the class with DatastoreQueryMixin. Only DatastoreQuery is defined here, and
+# so only querysets using it can be pickled, the others are created when they're first needed
+_datastore_query_classes = {
+    Query: DatastoreQuery,
+}
+
+
+def _get_datastore_query_class(query_class):
+    if issubclass(query_class, DatastoreQueryMixin):
+        return query_class
+
+    if query_class not in _datastore_query_classes:
+        name = "Datastore{}".format(query_class.__name__)
+        _datastore_query_classes[query_class] = type(name, (DatastoreQueryMixin, query_class), { "__module__": __name__ })
+
+    return _datastore_query_classes[query_class]
+
+
+def _with_datastore_query(queryset):
+    """ Returns a copy of the queryset which can carry datastore options """
+    queryset = queryset._clone()
+    queryset.query = queryset.query.clone(klass=_get_datastore_query_class(queryset.query.__class__))
+    return queryset
+
+
+def starting_cursor(queryset, cursor):
+    """
+        Returns a copy of the queryset which starts from the cursor (a websafe string, as returned by
+        get_cursor) rather than the start of the results. Any slicing is relative to the cursor. If
+        cursor is None the queryset starts from the beginning, but get_cursor can still be used on it.
+    """
+    queryset = _with_datastore_query(queryset)
+    queryset.query.starting_cursor = cursor
+    queryset.query.wants_cursor = True
+    return queryset
+
+
+def get_cursor(queryset):
+    """
+        Returns the cursor (as a websafe string) for the end of the queryset's results, which can be
+        passed to starting_cursor to carry on from there. The queryset is evaluated if it hasn't
+        been already. Raises NotSupportedError if the queryset can't have a cursor.
+    """
+    if not isinstance(queryset.query, DatastoreQueryMixin):
+        if queryset._result_cache is not None:
+            raise ValueError("The queryset was evaluated without a cursor, use starting_cursor(queryset, None) first")
+        queryset.query = queryset.query.clone(klass=_get_datastore_query_class(queryset.query.__class__))
+
+    if queryset._result_cache is None:
+        queryset.query.wants_cursor = True
+        len(queryset) # Evaluates the queryset
+
+    if queryset.query.end_cursor_error:
+        raise NotSupportedError(queryset.query.end_cursor_error)
+
+    return queryset.query.end_cursor
+
+
+def using_batch(queryset, batch_size, prefetch_size=None):
+    """
+        Returns a copy of the queryset which fetches batch_size results from the datastore at a
+        time. prefetch_size is the size of the first batch, which defaults to batch_size. While
+        one batch is being read the next is fetched in the background. Lookups by primary key
+        or unique combination don't run a datastore query, so the batch size doesn't apply to them.
+    """
+    queryset = _with_datastore_query(queryset)
+    queryset.query.batch_size = batch_size
+    queryset.query.prefetch_size = prefetch_size or batch_size
+    return queryset
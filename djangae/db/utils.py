@@ -1,7 +1,6 @@
 #STANDARD LIB
 from datetime import datetime
 from decimal import Decimal
-from itertools import chain
 
 import warnings
 
@@ -18,7 +17,6 @@ from google.appengine.api.datastore import Key, Query
 #DJANGAE
 from djangae.utils import memoized
 from djangae.indexing import special_indexes_for_column, REQUIRES_SPECIAL_INDEXES
-from djangae.db.backends.appengine.dbapi import CouldBeSupportedError
 
 
 def make_timezone_naive(value):
@@ -262,111 +260,165 @@ def key_exists(key):
     return qry.Count(limit=1) > 0
 
 
-def django_ordering_comparison(ordering, lhs, rhs):
-    if not ordering:
-        return -1  # Really doesn't matter
+def _datastore_type_rank(value):
+    """
+        Returns where values of this type sort relative to other types in the datastore, so that
+        columns holding None or mixed types are ordered in memory the way the datastore would
+    """
+    if value is None:
+        return 0
+    elif isinstance(value, bool):
+        # bool is a subclass of int, so this must come first
+        return 3
+    elif isinstance(value, (int, long)):
+        return 1
+    elif isinstance(value, datetime):
+        # The datastore stores these as integers, but they can't be compared with them here
+        return 2
+    elif isinstance(value, basestring):
+        return 4
+    elif isinstance(value, float):
+        return 5
+    elif isinstance(value, Key):
+        return 7
+    return 6
+
+
+class _Descending(object):
+    """ Wraps a sort key so that it sorts in reverse """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def get_ordering_sort_key(ordering):
+    """
+        Returns a key function for sorting entities in memory by the datastore ordering (a list
+        of (column, direction) tuples). The ordering is worked out once, so each entity only
+        costs a single call.
 
-    ASCENDING = 1
-    DESCENDING = 2
+        Like the datastore, list properties sort by their smallest value when ascending and
+        their largest value when descending.
+    """
+    columns = tuple(
+        (column == "__key__", column, direction == Query.DESCENDING)
+        for column, direction in ordering
+    )
+
+    def rank(value):
+        return (_datastore_type_rank(value), value)
+
+    def sort_key(entity):
+        result = []
+        for is_key, column, descending in columns:
+            value = entity.key() if is_key else entity.get(column)
+            if isinstance(value, list):
+                value = (max if descending else min)([ rank(x) for x in value ]) if value else rank(None)
+            else:
+                value = rank(value)
+            result.append(_Descending(value) if descending else value)
+        return tuple(result)
 
-    for order, direction in ordering:
-        lhs_value = lhs.key() if order == "__key__" else lhs[order]
-        rhs_value = rhs.key() if order == "__key__" else rhs[order]
+    return sort_key
 
-        if direction == ASCENDING and lhs_value != rhs_value:
-            return -1 if lhs_value < rhs_value else 1
-        elif direction == DESCENDING and lhs_value != rhs_value:
-            return 1 if lhs_value < rhs_value else -1
 
-    return 0
+def _lt(x, y):
+    if x is None and y is not None:
+        return True
+    elif x is not None and y is None:
+        return False
+    else:
+        return x < y
 
 
-def entity_matches_query(entity, query):
-    """
-        Return True if the entity would potentially be returned by the datastore
-        query
-    """
+def _gt(x, y):
+    if x is None and y is not None:
+        return False
+    elif x is not None and y is None:
+        return True
+    else:
+        return x > y
 
-    def lt(x, y):
-        if x is None and y is not None:
-            return True
-        elif x is not None and y is None:
-            return False
-        else:
-            return x < y
 
-    def gt(x, y):
-        if x is None and y is not None:
-            return False
-        elif x is not None and y is None:
-            return True
-        else:
-            return x > y
+_OPERATORS = {
+    "=": lambda x, y: x == y,
+    "<": _lt,
+    ">": _gt,
+    "<=": lambda x, y: not _gt(x, y),
+    ">=": lambda x, y: not _lt(x, y),
+}
 
-    gte = lambda x, y: not lt(x, y)
-    lte = lambda x, y: not gt(x, y)
 
-    OPERATORS = {
-        "=": lambda x, y: x == y,
-        "<": lt,
-        ">": gt,
-        "<=": lte,
-        ">=": gte
-    }
+class QueryMatcher(object):
+    """
+        A datastore query (or MultiQuery) compiled into a predicate which returns True if the
+        entity would potentially be returned by the query. Compiling works out the filters once,
+        so create a matcher and call it for each entity rather than calling entity_matches_query
+        in a loop.
+    """
 
-    queries = [query]
-    if isinstance(query, datastore.MultiQuery):
-        raise CouldBeSupportedError("We just need to separate the multiquery "
-                                    "into 'queries' then everything should work")
+    def __init__(self, query):
+        if isinstance(query, datastore.MultiQuery):
+            queries = query._MultiQuery__bound_queries
+        else:
+            queries = [query]
 
-    for query in queries:
-        comparisons = chain(
-            [("kind", "=", "_Query__kind") ],
-            [tuple(x.split(" ") + [ x ]) for x in query.keys()]
-        )
+        self.branches = [ self._compile(x) for x in queries ]
 
-        for ent_attr, op, query_attr in comparisons:
+    @staticmethod
+    def _compile(query):
+        filters = []
+        for key, values in query.items():
+            ent_attr, op = key.split(" ")
             if ent_attr == "__key__":
                 continue
 
-            op = OPERATORS[op]  # We want this to throw if there's some op we don't know about
+            op = _OPERATORS[op]  # We want this to throw if there's some op we don't know about
 
-            if ent_attr == "kind":
-                ent_attr = entity.kind()
-            else:
-                ent_attr = entity.get(ent_attr)
+            if not isinstance(values, (list, tuple)):
+                values = [ values ]
 
-            if callable(ent_attr):
-                # entity.kind() is a callable, so we need this to save special casing it in a more
-                # ugly way
-                ent_attr = ent_attr()
+            # The query value can be a list of ANDed values
+            filters.append((ent_attr, op, tuple(values)))
 
-            if not isinstance(query_attr, (list, tuple)):
-                query_attrs = [query_attr]
-            else:
-                # The query value can be a list of ANDed values
-                query_attrs = query_attr
+        return query._Query__kind, tuple(filters)
 
-            query_attrs = [ getattr(query, x) if x == "_Query__kind" else query.get(x) for x in query_attrs ]
+    def __call__(self, entity):
+        kind = entity.kind()
 
-            if not isinstance(ent_attr, (list, tuple)):
-                ent_attr = [ ent_attr ]
+        for query_kind, filters in self.branches:
+            if kind != query_kind:
+                continue
 
-            matches = False
-            for query_attr in query_attrs:  # [22, 23]
-                #If any of the values don't match then this query doesn't match
-                if not any([op(attr, query_attr) for attr in ent_attr]):
-                    matches = False
+            for ent_attr, op, values in filters:
+                ent_value = entity.get(ent_attr)
+
+                if isinstance(ent_value, (list, tuple)):
+                    # If any of the entity's values match then the filter matches
+                    if not all(any(op(x, value) for x in ent_value) for value in values):
+                        break
+                elif not all(op(ent_value, value) for value in values):
                     break
             else:
-                # One of the ent_attrs matches the query_attrs
-                matches = True
+                # If we got through the filters without breaking, then the entity matches
+                return True
 
-            if not matches:
-                # One of the AND values didn't match
-                break
-        else:
-            # If we got through the loop without breaking, then the entity matches
-            return True
+        return False
 
-    return False
+
+def entity_matches_query(entity, query):
+    """
+        Return True if the entity would potentially be returned by the datastore
+        query. Use a QueryMatcher when checking more than one entity against a query.
+    """
+    return QueryMatcher(query)(entity)
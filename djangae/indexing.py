@@ -7,6 +7,7 @@ from djangae.sandbox import allow_mode_write
 from django.conf import settings
 
 _special_indexes = {}
+_special_indexes_version = 0
 _last_loaded_time = None
 
 MAX_COLUMNS_PER_SPECIAL_INDEX = getattr(settings, "DJANGAE_MAX_COLUMNS_PER_SPECIAL_INDEX", 3)
@@ -23,6 +24,19 @@ def _get_table_from_model(model_class):
     return model_class._meta.db_table.encode("utf-8")
 
 
+def _special_indexes_changed():
+    global _special_indexes_version
+    _special_indexes_version += 1
+
+
+def special_indexes_version():
+    """
+        Returns a number which changes whenever the special indexes do, so that anything derived
+        from them can be recalculated
+    """
+    return _special_indexes_version
+
+
 def load_special_indexes():
     global _special_indexes
     global _last_loaded_time
@@ -44,6 +58,7 @@ def load_special_indexes():
 
     _special_indexes = data
     _last_loaded_time = mtime
+    _special_indexes_changed()
 
     logging.debug("Loaded special indexes for {0} models".format(len(_special_indexes)))
 
@@ -90,6 +105,7 @@ def add_special_index(model_class, field_name, index_type):
     _special_indexes.setdefault(
         _get_table_from_model(model_class), {}
     ).setdefault(field_name, []).append(str(index_type))
+    _special_indexes_changed()
 
     write_special_indexes()
 
@@ -4,18 +4,34 @@ from google.appengine.api import datastore
 from google.appengine.api import datastore_errors
 from google.appengine.ext.db import non_transactional
 
-from django.db import models
-from django.http import HttpRequest
+from django.db import models, NotSupportedError
+from django.http import HttpRequest, HttpResponse
 from django.core.signals import request_finished, request_started
 from django.core.cache import cache
 
 from djangae.contrib import sleuth
+from djangae.contrib.common.middleware import CacheStatsMiddleware
 from djangae.test import TestCase
+from djangae import indexing
 from djangae.db import unique_utils
 from djangae.db import transaction
-from djangae.db.backends.appengine.context import ContextStack
-from djangae.db.backends.appengine import caching
-from djangae.db.caching import disable_cache, clear_context_cache
+from djangae.db.backends.appengine.context import ContextStack, ProcessCache
+from djangae.db.backends.appengine import caching, cache_stats
+from djangae.db.caching import disable_cache, clear_context_cache, clear_process_cache, prefetch, prefetch_queryset
+from djangae.db.cursors import starting_cursor, get_cursor, using_batch
+
+
+def get_from_memcache(identifier):
+    """
+        Returns what the caching layer has stored in memcache for the identifier, following
+        pointers to the entity
+    """
+    caching.wait_for_memcache_rpcs()
+
+    value = caching._unstamp(identifier, cache.get(caching._prefixed(identifier)))
+    if caching._is_pointer(value):
+        return get_from_memcache(value[1])
+    return caching._decode_entity(value)
 
 
 class FakeEntity(dict):
@@ -88,6 +104,174 @@ class ContextStackTests(TestCase):
 
         self.assertEqual({"field1": "oneone"}, stack.top.cache["entity"])
 
+    def test_identifiers_share_a_single_snapshot(self):
+        stack = ContextStack()
+
+        entity = FakeEntity({"field1": "one", "list": [1, 2]})
+
+        with sleuth.watch("djangae.db.backends.appengine.context.freeze_entity") as freeze:
+            stack.top.cache_entity(["a", "b", "c"], entity, caching.CachingSituation.DATASTORE_PUT)
+            self.assertEqual(1, freeze.call_count)
+
+        with sleuth.watch("copy.deepcopy") as deepcopy:
+            cached = stack.top.cache["a"]
+            self.assertFalse(deepcopy.called)
+
+        self.assertIs(stack.top.cache._store["a"], stack.top.cache._store["c"])
+
+        # Altering the original or what we read back mustn't affect the cache
+        entity["field1"] = "two"
+        cached["field1"] = "three"
+        cached["list"].append(3)
+        del cached["list"]
+
+        self.assertEqual({"field1": "three"}, cached)
+        self.assertEqual({"field1": "one", "list": [1, 2]}, stack.top.cache["b"])
+        self.assertEqual(entity.key(), stack.top.get_entity_by_key(entity.key()).key())
+
+
+    def test_least_recently_used_entities_are_evicted(self):
+        stack = ContextStack(max_entities=2)
+
+        first = FakeEntity({"field1": "one"})
+        second = FakeEntity({"field1": "two"})
+        third = FakeEntity({"field1": "three"})
+
+        stack.top.cache_entity(["first", "first_unique"], first, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.cache_entity(["second", "second_unique"], second, caching.CachingSituation.DATASTORE_PUT)
+
+        # Reading the first entity makes the second the least recently used
+        self.assertIsNotNone(stack.top.get_entity_by_key(first.key()))
+
+        stack.top.cache_entity(["third", "third_unique"], third, caching.CachingSituation.DATASTORE_PUT)
+
+        self.assertItemsEqual(["first", "first_unique", "third", "third_unique"], stack.top.cache.keys())
+        self.assertItemsEqual([first.key(), third.key()], stack.top.reverse_cache.keys())
+        self.assertIsNone(stack.top.get_entity_by_key(second.key()))
+
+    def test_transaction_contexts_arent_bounded_until_commit(self):
+        stack = ContextStack(max_entities=1)
+        stack.push()
+
+        entities = [ FakeEntity({"field1": x}) for x in ("one", "two", "three") ]
+        for i, entity in enumerate(entities):
+            stack.top.cache_entity(["entity{}".format(i)], entity, caching.CachingSituation.DATASTORE_PUT)
+
+        # Nothing is evicted inside the transaction, so it always sees its own writes
+        self.assertEqual(3, len(stack.top.reverse_cache))
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.remove_entities_from_memcache_by_keys", lambda *args, **kwargs: None) as remove:
+            stack.pop(apply_staged=True, clear_staged=True)
+
+        self.assertEqual(1, remove.call_count)
+        self.assertItemsEqual([ x.key() for x in entities ], remove.calls[0][0][0].keys())
+        self.assertItemsEqual(["entity2"], stack.top.cache.keys())
+
+    def test_removed_entities_dont_count_towards_the_limit(self):
+        stack = ContextStack(max_entities=2)
+
+        first = FakeEntity({"field1": "one"})
+        second = FakeEntity({"field1": "two"})
+        third = FakeEntity({"field1": "three"})
+
+        stack.top.cache_entity(["first"], first, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.cache_entity(["second"], second, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.remove_entity(second.key())
+        stack.top.cache_entity(["third"], third, caching.CachingSituation.DATASTORE_PUT)
+
+        self.assertItemsEqual(["first", "third"], stack.top.cache.keys())
+        self.assertItemsEqual([first.key(), third.key()], stack.top.reverse_cache.keys())
+        self.assertEqual(2, len(stack.top._lru))
+
+    def test_entities_removed_in_a_transaction_are_invalidated_on_commit(self):
+        stack = ContextStack(max_entities=2)
+        entity = FakeEntity({"field1": "one"})
+
+        stack.push()
+        stack.top.cache_entity(["pk", "field1:one"], entity, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.remove_entity(entity.key())
+        self.assertFalse(stack.top.reverse_cache)
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.remove_entities_from_memcache_by_keys", lambda *args, **kwargs: None) as remove:
+            stack.pop(apply_staged=True, clear_staged=True)
+
+        self.assertEqual({ entity.key(): set(["pk", "field1:one"]) }, remove.calls[0][0][0])
+        self.assertFalse(stack.top.cache.keys())
+        self.assertFalse(stack.top._lru)
+
+    def test_commit_only_touches_what_is_still_cached(self):
+        stack = ContextStack(max_entities=2)
+
+        first = FakeEntity({"field1": "one"})
+        second = FakeEntity({"field1": "two"})
+        stack.top.cache_entity(["first"], first, caching.CachingSituation.DATASTORE_GET)
+
+        stack.push()
+        # The missing marker is replaced by the entity, so it mustn't take up a place on commit
+        stack.top.cache_missing(["second_unique"])
+        stack.top.cache_entity(["second", "second_unique"], second, caching.CachingSituation.DATASTORE_PUT)
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.remove_entities_from_memcache_by_keys", lambda *args, **kwargs: None):
+            stack.pop(apply_staged=True, clear_staged=True)
+
+        self.assertItemsEqual(["first", "second", "second_unique"], stack.top.cache.keys())
+        self.assertItemsEqual([first.key(), second.key()], stack.top._lru.keys())
+
+    def test_stale_identifiers_are_removed(self):
+        stack = ContextStack()
+
+        entity = FakeEntity({"field1": "one"})
+        stack.top.cache_entity(["pk", "field1:one"], entity, caching.CachingSituation.DATASTORE_PUT)
+
+        entity["field1"] = "two"
+        stack.top.cache_entity(["pk", "field1:two"], entity, caching.CachingSituation.DATASTORE_PUT)
+
+        self.assertItemsEqual(["pk", "field1:two"], stack.top.cache.keys())
+
+    def test_commit_only_replays_changes(self):
+        stack = ContextStack()
+
+        untouched = [ FakeEntity({"field1": x}) for x in xrange(100) ]
+        for entity in untouched:
+            stack.top.cache_entity(["untouched{}".format(entity.id)], entity, caching.CachingSituation.DATASTORE_GET)
+
+        updated = FakeEntity({"field1": "one"})
+        removed = FakeEntity({"field1": "two"})
+        stack.top.cache_entity(["updated", "field1:one"], updated, caching.CachingSituation.DATASTORE_GET)
+        stack.top.cache_entity(["removed"], removed, caching.CachingSituation.DATASTORE_GET)
+
+        stack.push() # Enter transaction
+
+        updated["field1"] = "three"
+        stack.top.cache_entity(["updated", "field1:three"], updated, caching.CachingSituation.DATASTORE_PUT)
+
+        # The removed entity was never cached inside the transaction, it must still go on commit
+        stack.top.remove_entity(removed.key())
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.remove_entities_from_memcache_by_keys", lambda *args, **kwargs: None):
+            with sleuth.watch("djangae.db.backends.appengine.context.SnapshotDict.__iter__") as iterate:
+                stack.pop(apply_staged=True, clear_staged=True)
+
+        self.assertFalse(iterate.called)
+        self.assertEqual(1, stack.size)
+        self.assertEqual({"field1": "three"}, stack.top.cache["updated"])
+        self.assertEqual({"field1": "three"}, stack.top.cache["field1:three"])
+        self.assertFalse("field1:one" in stack.top.cache)
+        self.assertFalse("removed" in stack.top.cache)
+        self.assertEqual(len(untouched) + 2, len(stack.top.cache))
+
+    def test_rollback_discards_changes(self):
+        stack = ContextStack()
+
+        entity = FakeEntity({"field1": "one"})
+        stack.top.cache_entity(["entity"], entity, caching.CachingSituation.DATASTORE_GET)
+
+        stack.push()
+        stack.top.remove_entity(entity.key())
+        stack.top.cache_entity(["other"], FakeEntity({"field1": "two"}), caching.CachingSituation.DATASTORE_PUT)
+        stack.pop(discard=True)
+
+        self.assertItemsEqual(["entity"], stack.top.cache.keys())
 
 
 class CachingTestModel(models.Model):
@@ -129,8 +313,9 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
         with transaction.atomic():
             instance.field1 = "Banana"
@@ -140,7 +325,7 @@ class MemcacheCachingTests(TestCase):
         # and that a get then hits the datastore (which then in turn caches)
         with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
             for identifier in identifiers:
-                self.assertIsNone(cache.get(identifier))
+                self.assertIsNone(get_from_memcache(identifier))
 
             self.assertEqual("Banana", CachingTestModel.objects.get(pk=instance.pk).field1)
             self.assertTrue(datastore_get.called)
@@ -157,24 +342,25 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
         instance.delete()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         with transaction.atomic():
             instance = CachingTestModel.objects.create(**entity_data)
 
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_save_wipes_entity_from_cache_inside_transaction(self):
@@ -187,18 +373,19 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
         with transaction.atomic():
             instance.save()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_transactional_save_wipes_the_cache_only_after_its_result_is_consistently_available(self):
@@ -208,12 +395,13 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual("old", cache.get(identifier)["field1"])
+            self.assertEqual("old", get_from_memcache(identifier)["field1"])
 
         @non_transactional
         def non_transactional_read(instance_pk):
@@ -224,8 +412,285 @@ class MemcacheCachingTests(TestCase):
             instance.save()
             non_transactional_read(instance.pk)  # could potentially recache the old object
 
+        # The invalidation on commit is asynchronous
+        caching.wait_for_memcache_rpcs()
+
+        for identifier in identifiers:
+            self.assertIsNone(get_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_eviction_doesnt_need_the_cached_entity(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        instance = CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
+
+        # Simulate memcache evicting the entry for the primary key
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        cache.delete(caching._prefixed(cache_key))
+
+        with sleuth.watch("django.core.cache.cache.get") as memcache_get:
+            with sleuth.watch("django.core.cache.cache.delete_many") as memcache_delete:
+                instance.delete()
+
+        self.assertEqual(1, memcache_delete.call_count)
+        self.assertNotIn(cache_key, [ x[0][0] for x in memcache_get.calls ])
+
+        for identifier in identifiers:
+            self.assertIsNone(get_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_commit_invalidates_memcache_in_one_batch(self):
+        first = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        second = CachingTestModel.objects.create(field1="Banana", comb1=2, comb2="Cherry")
+
+        with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+            with transaction.atomic(xg=True):
+                first.save()
+                second.save()
+
+                get_many_calls = memcache_get_many.call_count
+
+            # Once for the whole commit
+            self.assertEqual(get_many_calls + 1, memcache_get_many.call_count)
+
+        caching.wait_for_memcache_rpcs()
+
+        for instance in (first, second):
+            identifiers = unique_utils.unique_identifiers_from_entity(
+                CachingTestModel, FakeEntity({"field1": instance.field1, "comb1": instance.comb1, "comb2": instance.comb2}, id=instance.pk)
+            )
+            for identifier in identifiers:
+                self.assertIsNone(get_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_memcache_is_populated_asynchronously(self):
+        with sleuth.watch("django.core.cache.cache.set_many") as memcache_set_many:
+            instance = CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+
+        self.assertFalse(memcache_set_many.called)
+
+        request_finished.send(HttpRequest(), keep_disabled_flags=True)
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, instance.pk)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        self.assertEqual("Apple", get_from_memcache(cache_key)["field1"])
+
+    @disable_cache(memcache=False, context=True)
+    def test_pending_memcache_calls_are_bounded(self):
+        original_max_pending = caching.MAX_PENDING_MEMCACHE_RPCS
+        caching.MAX_PENDING_MEMCACHE_RPCS = 2
+        try:
+            for i in xrange(5):
+                CachingTestModel.objects.create(field1="Apple{}".format(i), comb1=i, comb2="Cherry")
+                self.assertTrue(len(caching._context.pending_rpcs) <= 2)
+        finally:
+            caching.MAX_PENDING_MEMCACHE_RPCS = original_max_pending
+
+        self.assertEqual("Apple0", CachingTestModel.objects.get(field1="Apple0").field1)
+
+    @disable_cache(memcache=False, context=True)
+    def test_invalidation_wins_over_fill_in_flight(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
+
+        CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
+        cache.clear()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        original_get = datastore.Get
+
+        def get_then_invalidate(*args, **kwargs):
+            result = original_get(*args, **kwargs)
+            # Simulate another request updating the entity before we fill the cache
+            caching.remove_entity_from_cache_by_key(key, memcache_only=True)
+            return result
+
+        with sleuth.switch("djangae.db.backends.appengine.commands.datastore.Get", get_then_invalidate):
+            CachingTestModel.objects.get(pk=222)
+
+        for identifier in identifiers:
+            self.assertIsNone(get_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_fill_after_miss_is_asynchronous(self):
+        CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+        caching.wait_for_memcache_rpcs()
+        cache.clear()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        with sleuth.watch("django.core.cache.cache.set_many") as memcache_set_many:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+        # The fill is waiting to be finished off with the other asynchronous memcache calls
+        self.assertFalse(memcache_set_many.called)
+        self.assertTrue(any(isinstance(x, caching._PendingFill) for x in caching._context.pending_rpcs))
+        self.assertIsInstance(cache.get(caching._prefixed(cache_key)), caching.Lease)
+
+        self.assertEqual("Apple", get_from_memcache(cache_key)["field1"])
+
+    @disable_cache(memcache=False, context=True)
+    def test_miss_waits_for_lease_holder(self):
+        CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+        caching.wait_for_memcache_rpcs()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        # Another request has missed and is filling the cache
+        cache.set(caching._prefixed(cache_key), caching.Lease(1))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+        # We gave up waiting, but we don't replace the other request's lease
+        self.assertTrue(datastore_get.called)
+        self.assertIsInstance(get_from_memcache(cache_key), caching.Lease)
+
+    @disable_cache(memcache=False, context=True)
+    def test_entities_cached_by_other_versions_are_ignored(self):
+        CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        # Simulate the entity being cached by a version of the app with different fields
+        stale = get_from_memcache(cache_key)
+        stale["field1"] = "Banana"
+        cache.set(caching._prefixed(cache_key), ("other", stale))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+        self.assertTrue(datastore_get.called)
+        self.assertEqual("Apple", get_from_memcache(cache_key)["field1"])
+
+    @disable_cache(memcache=False, context=True)
+    def test_unstamped_entities_are_ignored(self):
+        CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        # Simulate the entity being cached, as it is, by a version of the app from before stamping
+        stale = get_from_memcache(cache_key)
+        stale["field1"] = "Banana"
+        cache.set(caching._prefixed(cache_key), stale)
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+        self.assertTrue(datastore_get.called)
+        self.assertEqual("Apple", get_from_memcache(cache_key)["field1"])
+
+    @disable_cache(memcache=False, context=True)
+    def test_values_are_kept_apart_from_old_instances(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+        caching.wait_for_memcache_rpcs()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        # Instances running the old code cache entities as they are, under the bare identifiers
+        stale = get_from_memcache(cache_key)
+        stale["field1"] = "Banana"
+        cache.set(cache_key, stale)
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+        self.assertFalse(datastore_get.called)
+
+        # Our writes remove what they cached, so that they don't keep serving it
+        instance.field1 = "Damson"
+        instance.save()
+        caching.wait_for_memcache_rpcs()
+
+        self.assertIsNone(cache.get(cache_key))
+        self.assertEqual("Damson", get_from_memcache(cache_key)["field1"])
+
+    def test_cache_version_changes_with_special_indexes(self):
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        version = caching._get_cache_version(cache_key)
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.special_indexes_for_model", lambda model: {"comb2": ["iexact"]}):
+            indexing._special_indexes_changed()
+            self.assertNotEqual(version, caching._get_cache_version(cache_key))
+
+        indexing._special_indexes_changed()
+        self.assertEqual(version, caching._get_cache_version(cache_key))
+
+    @disable_cache(memcache=False, context=True)
+    def test_entity_is_stored_once_in_memcache(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+        caching.wait_for_memcache_rpcs()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity({"field1": "Apple", "comb1": 1, "comb2": "Cherry"}, id=222))
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            value = caching._unstamp(identifier, cache.get(caching._prefixed(identifier)))
+            if identifier == cache_key:
+                self.assertFalse(caching._is_pointer(value))
+            else:
+                self.assertEqual((caching._POINTER, cache_key), value)
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual(instance, CachingTestModel.objects.get(field1="Apple"))
+
+        self.assertFalse(datastore_query.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_large_entities_are_compressed(self):
+        threshold = caching.CACHE_COMPRESSION_THRESHOLD
+        caching.CACHE_COMPRESSION_THRESHOLD = 0
+        try:
+            instance = CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+            caching.wait_for_memcache_rpcs()
+        finally:
+            caching.CACHE_COMPRESSION_THRESHOLD = threshold
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        self.assertEqual(caching._COMPRESSED_ENTITY, caching._unstamp(cache_key, cache.get(caching._prefixed(cache_key)))[0])
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual("Apple", CachingTestModel.objects.get(pk=instance.pk).field1)
+
+        self.assertFalse(datastore_get.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_pointers_to_evicted_entities_are_refilled(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple", comb1=1, comb2="Cherry")
+        caching.wait_for_memcache_rpcs()
+
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        cache.delete(caching._prefixed(cache_key))
+
+        self.assertEqual(instance, CachingTestModel.objects.get(field1="Apple"))
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual(instance, CachingTestModel.objects.get(field1="Apple"))
+
+        self.assertFalse(datastore_query.called)
 
     @disable_cache(memcache=False, context=True)
     def test_consistent_read_updates_memcache_outside_transaction(self):
@@ -238,22 +703,24 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
         cache.clear()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         CachingTestModel.objects.get(id=222) # Consistent read
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_eventual_read_doesnt_update_memcache(self):
@@ -266,22 +733,23 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         CachingTestModel.objects.create(id=222, **entity_data)
+        caching.wait_for_memcache_rpcs()
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, get_from_memcache(identifier))
 
         cache.clear()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
         CachingTestModel.objects.all()[0] # Inconsistent read
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(get_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_unique_filter_hits_memcache(self):
@@ -346,6 +814,109 @@ class MemcacheCachingTests(TestCase):
 
         self.assertFalse(datastore_get.called)
 
+    @disable_cache(memcache=False, context=True)
+    def test_multiple_keys_hit_memcache_before_datastore(self):
+        first = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        second = CachingTestModel.objects.create(field1="Banana", comb1=2, comb2="Cherry")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+                instances = CachingTestModel.objects.filter(pk__in=[first.pk, second.pk])
+                self.assertItemsEqual([first, second], instances)
+
+        self.assertFalse(datastore_get.called)
+        self.assertEqual(1, memcache_get_many.call_count)
+
+        # Evict one of them, only that one should be fetched from the datastore
+        caching.remove_entity_from_cache_by_key(datastore.Key.from_path(CachingTestModel._meta.db_table, second.pk))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            instances = CachingTestModel.objects.filter(pk__in=[first.pk, second.pk])
+            self.assertItemsEqual([first, second], instances)
+
+        self.assertEqual(1, datastore_get.call_count)
+        self.assertEqual(
+            [datastore.Key.from_path(CachingTestModel._meta.db_table, second.pk)],
+            datastore_get.calls[0][0][0]
+        )
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_key_is_cached_until_put(self):
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=999)))
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=999)))
+
+        self.assertEqual(1, datastore_get.call_count)
+
+        CachingTestModel.objects.create(id=999, field1="Apple", comb1=1, comb2="Cherry")
+        self.assertEqual("Apple", CachingTestModel.objects.get(pk=999).field1)
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_key_isnt_cached_after_an_invalidation(self):
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 999)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        def get_and_invalidate(keys, *args, **kwargs):
+            # Another request writes the entity, and invalidates it, while our Get is in flight
+            caching.remove_entity_from_cache_by_key(key, memcache_only=True)
+            return [ None for x in keys ]
+
+        with sleuth.switch("google.appengine.api.datastore.Get", get_and_invalidate):
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=999)))
+
+        caching.wait_for_memcache_rpcs()
+        self.assertIsNone(cache.get(caching._prefixed(cache_key)))
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_unique_identifier_is_cached_until_put(self):
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+            self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+
+        self.assertEqual(1, datastore_query.call_count)
+
+        with transaction.atomic():
+            original = CachingTestModel.objects.create(id=999, field1="Apple", comb1=1, comb2="Cherry")
+
+        self.assertEqual(original, CachingTestModel.objects.get(field1="Apple"))
+
+        # A save outside a transaction replaces the cached miss too
+        self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Banana")
+        CachingTestModel.objects.create(id=1000, field1="Banana", comb1=2, comb2="Cherry")
+        self.assertEqual(1000, CachingTestModel.objects.get(field1="Banana").pk)
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_unique_identifier_isnt_cached_while_it_has_a_marker(self):
+        with disable_cache():
+            original = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+
+        # The query is eventually consistent, so it can miss an entity which was only just saved. The
+        # marker for the unique combination exists though, so the miss isn't cached
+        with sleuth.switch("google.appengine.api.datastore.Query.Run", lambda *args, **kwargs: iter([])):
+            self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Apple")
+
+        self.assertEqual(original, CachingTestModel.objects.get(field1="Apple"))
+
+    @disable_cache(memcache=False, context=True)
+    def test_renamed_unique_field_is_found_by_new_value(self):
+        original = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+
+        self.assertRaises(CachingTestModel.DoesNotExist, CachingTestModel.objects.get, field1="Banana")
+
+        original.field1 = "Banana"
+        original.save()
+
+        self.assertEqual(original, CachingTestModel.objects.get(field1="Banana"))
+
+    @disable_cache(memcache=False, context=True)
+    def test_missing_isnt_cached_when_other_filters_applied(self):
+        self.assertEqual([], list(CachingTestModel.objects.filter(field1="Apple", comb1=0)))
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual([], list(CachingTestModel.objects.filter(field1="Apple")))
+
+        self.assertTrue(datastore_query.called)
+
     @disable_cache(memcache=False, context=True)
     def test_get_by_key_hits_datastore_inside_transaction(self):
         entity_data = {
@@ -419,6 +990,30 @@ class ContextCachingTests(TestCase):
         - filter/get by anything else does not (eventually consistent)
     """
 
+    @disable_cache(memcache=True, context=False)
+    def test_transaction_reads_its_own_writes_beyond_the_context_limit(self):
+        first = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+
+        original_max_entities = caching.CONTEXT_CACHE_MAX_ENTITIES
+        caching.CONTEXT_CACHE_MAX_ENTITIES = 2
+        clear_context_cache()
+        try:
+            with transaction.atomic():
+                first.field1 = "Apricot"
+                first.save()
+
+                for i in xrange(3):
+                    CachingTestModel.objects.create(field1="Banana{}".format(i), comb1=i + 2, comb2="Cherry")
+
+                with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                    self.assertEqual("Apricot", CachingTestModel.objects.get(pk=first.pk).field1)
+                    self.assertFalse(datastore_get.called)
+        finally:
+            caching.CONTEXT_CACHE_MAX_ENTITIES = original_max_entities
+            clear_context_cache()
+
+        self.assertEqual("Apricot", CachingTestModel.objects.get(pk=first.pk).field1)
+
     @disable_cache(memcache=True, context=False)
     def test_that_transactions_dont_inherit_context_cache(self):
         """
@@ -671,6 +1266,17 @@ class ContextCachingTests(TestCase):
 
         self.assertFalse(datastore_get.called)
 
+    @disable_cache(memcache=True, context=False)
+    def test_multiple_keys_hit_cache(self):
+        first = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        second = CachingTestModel.objects.create(field1="Banana", comb1=2, comb2="Cherry")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            instances = CachingTestModel.objects.filter(pk__in=[first.pk, second.pk])
+            self.assertItemsEqual([first, second], instances)
+
+        self.assertFalse(datastore_get.called)
+
     @disable_cache(memcache=True, context=False)
     def test_unique_get_hits_cache(self):
         entity_data = {
@@ -705,3 +1311,424 @@ class ContextCachingTests(TestCase):
             request_finished.send(HttpRequest(), keep_disabled_flags=True)
             CachingTestModel.objects.get(field1="test")
             self.assertEqual(query.call_count, 2)
+
+
+class QueryCachingTestModel(models.Model):
+    field1 = models.CharField(max_length=255)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        cache_query_results = True
+
+
+class QueryCachingTests(TestCase):
+
+    def setUp(self):
+        super(QueryCachingTests, self).setUp()
+        # The test datastore is always consistent, so we don't need to wait for writes to settle
+        self.settle_seconds = caching.QUERY_CACHE_SETTLE_SECONDS
+        caching.QUERY_CACHE_SETTLE_SECONDS = 0
+
+    def tearDown(self):
+        caching.QUERY_CACHE_SETTLE_SECONDS = self.settle_seconds
+        super(QueryCachingTests, self).tearDown()
+
+    def test_query_results_are_cached_until_a_write(self):
+        first = QueryCachingTestModel.objects.create(field1="Apple")
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual([first], list(QueryCachingTestModel.objects.filter(field1="Apple")))
+            self.assertEqual([first], list(QueryCachingTestModel.objects.filter(field1="Apple")))
+            self.assertEqual(1, datastore_query.call_count)
+
+            second = QueryCachingTestModel.objects.create(field1="Apple")
+
+            self.assertItemsEqual([first, second], QueryCachingTestModel.objects.filter(field1="Apple"))
+            self.assertEqual(2, datastore_query.call_count)
+
+            first.field1 = "Banana"
+            first.save()
+
+            self.assertEqual([second], list(QueryCachingTestModel.objects.filter(field1="Apple")))
+            self.assertEqual(3, datastore_query.call_count)
+
+            second.delete()
+
+            self.assertEqual([], list(QueryCachingTestModel.objects.filter(field1="Apple")))
+            self.assertEqual(4, datastore_query.call_count)
+
+    def test_transactional_write_invalidates_on_commit(self):
+        instance = QueryCachingTestModel.objects.create(field1="Apple")
+
+        with sleuth.watch("djangae.db.backends.appengine.caching.bump_generations") as bump:
+            with transaction.atomic():
+                instance.field1 = "Banana"
+                instance.save()
+
+                calls_inside = bump.call_count
+
+            self.assertEqual(calls_inside + 1, bump.call_count)
+
+    def test_queries_arent_cached_in_transactions(self):
+        self.assertIsNone(transaction.atomic()(lambda: caching.get_query_generation(QueryCachingTestModel))())
+
+    def test_querysets_which_want_a_cursor_skip_the_cache(self):
+        QueryCachingTestModel.objects.create(field1="Apple")
+
+        queryset = QueryCachingTestModel.objects.filter(field1="Apple")
+        list(queryset)
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertTrue(get_cursor(starting_cursor(queryset, None)))
+            self.assertTrue(get_cursor(queryset.all()))
+            self.assertEqual(2, datastore_query.call_count)
+
+        # Batch options alone don't stop the results coming from the cache, but then there's no cursor
+        batched = using_batch(queryset, 10)
+        list(batched)
+        self.assertRaises(NotSupportedError, get_cursor, batched)
+
+    def test_batch_options_are_passed_to_cached_queries(self):
+        QueryCachingTestModel.objects.create(field1="Apple")
+
+        queryset = using_batch(QueryCachingTestModel.objects.filter(field1="Apple"), 3, prefetch_size=2)
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual(1, len(queryset))
+
+        self.assertEqual(3, datastore_query.calls[0][1]["batch_size"])
+        self.assertEqual(2, datastore_query.calls[0][1]["prefetch_size"])
+
+    def test_counts_are_cached(self):
+        QueryCachingTestModel.objects.create(field1="Apple")
+
+        self.assertEqual(1, QueryCachingTestModel.objects.filter(field1="Apple").count())
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Count") as datastore_count:
+            self.assertEqual(1, QueryCachingTestModel.objects.filter(field1="Apple").count())
+
+        self.assertFalse(datastore_count.called)
+
+
+class QueryCursorCachingTestModel(models.Model):
+    field1 = models.IntegerField()
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        cache_query_cursors = True
+
+
+class QueryCursorCachingTests(TestCase):
+
+    def test_slices_continue_from_the_cursor_where_the_last_slice_ended(self):
+        for i in xrange(10):
+            QueryCursorCachingTestModel.objects.create(field1=i)
+
+        queryset = QueryCursorCachingTestModel.objects.order_by("field1")
+        self.assertEqual([0, 1, 2], [ x.field1 for x in queryset[:3] ])
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual([3, 4, 5], [ x.field1 for x in queryset[3:6] ])
+
+            self.assertEqual(1, datastore_query.call_count)
+            self.assertIsNotNone(datastore_query.calls[0][1].get("start_cursor"))
+            self.assertFalse(datastore_query.calls[0][1].get("offset"))
+
+            # Nothing ended at 7, so this has to use an offset
+            self.assertEqual([7, 8], [ x.field1 for x in queryset[7:9] ])
+            self.assertIsNone(datastore_query.calls[1][1].get("start_cursor"))
+            self.assertEqual(7, datastore_query.calls[1][1].get("offset"))
+
+    def test_different_queries_dont_share_cursors(self):
+        for i in xrange(10):
+            QueryCursorCachingTestModel.objects.create(field1=i)
+
+        list(QueryCursorCachingTestModel.objects.order_by("field1")[:3])
+
+        self.assertEqual([6, 5], [ x.field1 for x in QueryCursorCachingTestModel.objects.order_by("-field1")[3:5] ])
+        self.assertEqual([4, 5], [ x.field1 for x in QueryCursorCachingTestModel.objects.filter(field1__gte=1).order_by("field1")[3:5] ])
+
+
+class MemcacheDisabledModel(models.Model):
+    field1 = models.CharField(max_length=255, unique=True)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        disable_memcache = True
+
+
+class ContextCacheDisabledModel(models.Model):
+    field1 = models.CharField(max_length=255, unique=True)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        disable_context_cache = True
+
+
+class ShortMemcacheTimeoutModel(models.Model):
+    field1 = models.CharField(max_length=255, unique=True)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        memcache_timeout = 30
+
+
+class ModelCachingOptionsTests(TestCase):
+
+    @disable_cache(memcache=False, context=True)
+    def test_disable_memcache(self):
+        instance = MemcacheDisabledModel.objects.create(field1="Apple")
+        caching.wait_for_memcache_rpcs()
+
+        key = datastore.Key.from_path(MemcacheDisabledModel._meta.db_table, instance.pk)
+        cache_key, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        self.assertIsNone(get_from_memcache(cache_key))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+                self.assertEqual(instance, MemcacheDisabledModel.objects.get(pk=instance.pk))
+                self.assertEqual(instance, MemcacheDisabledModel.objects.get(field1="Apple"))
+
+        self.assertTrue(datastore_get.called)
+        self.assertFalse(memcache_get_many.called)
+        self.assertIsNone(get_from_memcache(cache_key))
+
+    @disable_cache(memcache=True, context=False)
+    def test_disable_context_cache(self):
+        instance = ContextCacheDisabledModel.objects.create(field1="Apple")
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual(instance, ContextCacheDisabledModel.objects.get(pk=instance.pk))
+
+        self.assertTrue(datastore_get.called)
+
+    def test_memcache_timeout(self):
+        with sleuth.watch("djangae.db.backends.appengine.caching._set_many_in_memcache_async") as memcache_set:
+            ShortMemcacheTimeoutModel.objects.create(field1="Apple")
+
+        self.assertEqual(30, memcache_set.calls[0][0][1])
+
+
+class ProcessCachingTestModel(models.Model):
+    field1 = models.CharField(max_length=255)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        cache_in_process = True
+
+
+class ProcessCachingTests(TestCase):
+
+    def setUp(self):
+        super(ProcessCachingTests, self).setUp()
+        clear_process_cache()
+
+    def _new_request(self):
+        request_finished.send(HttpRequest(), keep_disabled_flags=True)
+        request_started.send(HttpRequest(), keep_disabled_flags=True)
+
+    def test_entries_from_old_generations_arent_returned(self):
+        process_cache = ProcessCache(max_entities=10)
+        process_cache.cache_entity(["a"], FakeEntity({"field1": "Apple"}), "1")
+
+        self.assertEqual("Apple", process_cache.get_entity("a", "1")["field1"])
+        self.assertIsNone(process_cache.get_entity("a", "2"))
+        self.assertEqual(0, len(process_cache))
+
+    def test_process_cache_is_bounded(self):
+        process_cache = ProcessCache(max_entities=2)
+        process_cache.cache_entity(["a"], FakeEntity({"field1": "Apple"}), "1")
+        process_cache.cache_entity(["b"], FakeEntity({"field1": "Banana"}), "1")
+        process_cache.get_entity("a", "1")
+        process_cache.cache_entity(["c"], FakeEntity({"field1": "Cherry"}), "1")
+
+        self.assertIsNotNone(process_cache.get_entity("a", "1"))
+        self.assertIsNone(process_cache.get_entity("b", "1"))
+
+    def test_process_cache_limit_counts_entities(self):
+        process_cache = ProcessCache(max_entities=2)
+        process_cache.cache_entity(["a", "a_unique", "a_other"], FakeEntity({"field1": "Apple"}), "1")
+        process_cache.cache_entity(["b", "b_unique", "b_other"], FakeEntity({"field1": "Banana"}), "1")
+
+        self.assertEqual(2, len(process_cache))
+        for identifier in ("a", "a_unique", "a_other", "b", "b_unique", "b_other"):
+            self.assertIsNotNone(process_cache.get_entity(identifier, "1"))
+
+        process_cache.cache_entity(["c"], FakeEntity({"field1": "Cherry"}), "1")
+        self.assertEqual(2, len(process_cache))
+        self.assertIsNone(process_cache.get_entity("a_unique", "1"))
+        self.assertIsNotNone(process_cache.get_entity("b_unique", "1"))
+
+    @disable_cache(memcache=False, context=True)
+    def test_later_requests_dont_hit_memcache_for_entities(self):
+        instance = ProcessCachingTestModel.objects.create(field1="Apple")
+
+        self._new_request()
+        ProcessCachingTestModel.objects.get(pk=instance.pk)
+
+        self._new_request()
+        with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                self.assertEqual("Apple", ProcessCachingTestModel.objects.get(pk=instance.pk).field1)
+
+        self.assertFalse(memcache_get_many.called)
+        self.assertFalse(datastore_get.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_writes_invalidate_the_process_cache(self):
+        instance = ProcessCachingTestModel.objects.create(field1="Apple")
+
+        self._new_request()
+        ProcessCachingTestModel.objects.get(pk=instance.pk)
+
+        self._new_request()
+        instance.field1 = "Banana"
+        instance.save()
+
+        self._new_request()
+        self.assertEqual("Banana", ProcessCachingTestModel.objects.get(pk=instance.pk).field1)
+
+
+class CacheStatsTests(TestCase):
+
+    def setUp(self):
+        super(CacheStatsTests, self).setUp()
+        cache_stats.start_request()
+
+    def test_context_hits_and_misses_are_counted(self):
+        instance = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        CachingTestModel.objects.get(pk=instance.pk)
+        list(CachingTestModel.objects.filter(pk=instance.pk + 1))
+
+        counts = cache_stats.get_request_stats().counts[CachingTestModel._meta.db_table]
+        self.assertEqual(1, counts[cache_stats.CONTEXT_HIT])
+        self.assertEqual(1, counts[cache_stats.MISS])
+
+    @disable_cache(memcache=False, context=True)
+    def test_memcache_hits_and_fills_are_counted(self):
+        instance = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        CachingTestModel.objects.get(pk=instance.pk)
+
+        stats = cache_stats.get_request_stats()
+        counts = stats.counts[CachingTestModel._meta.db_table]
+        self.assertEqual(1, counts[cache_stats.FILL])
+        self.assertEqual(1, counts[cache_stats.MEMCACHE_HIT])
+        self.assertIn("memcache_get", stats.timings)
+
+        instance.delete()
+        self.assertEqual(1, counts[cache_stats.INVALIDATION])
+
+    def test_nested_timings_arent_counted_twice(self):
+        stats = cache_stats.get_request_stats()
+        stats.timings.clear()
+
+        times = iter([0.0, 1.0, 3.0, 4.0])
+        with sleuth.switch("djangae.db.backends.appengine.cache_stats.time.time", lambda: next(times)):
+            with cache_stats.timed("memcache_get"):
+                with cache_stats.timed("memcache_wait"):
+                    pass
+
+        self.assertEqual((1, 2.0), stats.timings["memcache_wait"])
+        self.assertEqual((1, 2.0), stats.timings["memcache_get"])
+
+    def test_stats_hook_is_called_when_the_request_finishes(self):
+        finished = []
+
+        hook = cache_stats.STATS_HOOK
+        cache_stats.STATS_HOOK = finished.append
+        try:
+            CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+            stats = cache_stats.get_request_stats()
+            request_finished.send(HttpRequest(), keep_disabled_flags=True)
+        finally:
+            cache_stats.STATS_HOOK = hook
+
+        self.assertEqual([stats], finished)
+        self.assertIsNot(stats, cache_stats.get_request_stats())
+
+    def test_end_of_request_memcache_wait_is_recorded(self):
+        def broken_hook(stats):
+            raise ValueError("Broken")
+
+        hook = cache_stats.STATS_HOOK
+        cache_stats.STATS_HOOK = broken_hook
+        try:
+            CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+            stats = cache_stats.get_request_stats()
+            waits = stats.timings.get("memcache_wait", (0, 0.0))[0]
+
+            # The hook's error is logged rather than raised
+            request_finished.send(HttpRequest(), keep_disabled_flags=True)
+        finally:
+            cache_stats.STATS_HOOK = hook
+
+        self.assertEqual(waits + 1, stats.timings["memcache_wait"][0])
+
+    def test_middleware_adds_header(self):
+        middleware = CacheStatsMiddleware()
+
+        with self.settings(DEBUG=True):
+            response = middleware.process_response(HttpRequest(), HttpResponse())
+
+        self.assertIn("context_hit=0", response["X-Djangae-Cache-Stats"])
+
+
+class PrefetchTests(TestCase):
+
+    def test_prefetch_loads_the_context(self):
+        instances = [
+            CachingTestModel.objects.create(field1=x, comb1=i, comb2="Cherry")
+            for i, x in enumerate(("Apple", "Banana", "Cherry"))
+        ]
+        missing_pk = instances[-1].pk + 1
+
+        # One of them is only in the datastore
+        caching.remove_entity_from_cache_by_key(
+            datastore.Key.from_path(CachingTestModel._meta.db_table, instances[0].pk)
+        )
+        clear_context_cache()
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+                prefetch(CachingTestModel, [ x.pk for x in instances ] + [missing_pk])
+
+        self.assertEqual(1, datastore_get.call_count)
+        self.assertEqual(2, len(datastore_get.calls[0][0][0]))
+        self.assertEqual(1, memcache_get_many.call_count)
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            with sleuth.watch("django.core.cache.cache.get_many") as memcache_get_many:
+                for instance in instances:
+                    self.assertEqual(instance, CachingTestModel.objects.get(pk=instance.pk))
+                self.assertEqual([], list(CachingTestModel.objects.filter(pk=missing_pk)))
+
+        self.assertFalse(datastore_get.called)
+        self.assertFalse(memcache_get_many.called)
+
+    def test_prefetch_queryset(self):
+        instance = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+        clear_context_cache()
+
+        prefetch_queryset(CachingTestModel.objects.filter(comb2="Cherry"))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual(instance, CachingTestModel.objects.get(pk=instance.pk))
+
+        self.assertFalse(datastore_get.called)
+
+    def test_prefetch_inside_a_transaction_raises(self):
+        instance = CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
+
+        with transaction.atomic():
+            self.assertRaises(RuntimeError, prefetch, CachingTestModel, [instance.pk])
@@ -35,11 +35,13 @@ from django.db import IntegrityError, NotSupportedError
 from djangae.db.constraints import UniqueMarker, UniquenessMixin
 from djangae.db.unique_utils import _unique_combinations, unique_identifiers_from_entity
 from djangae.indexing import add_special_index
-from djangae.db.utils import entity_matches_query, decimal_to_string, normalise_field_value
+from djangae.db.utils import entity_matches_query, QueryMatcher, get_ordering_sort_key, decimal_to_string, normalise_field_value
 from djangae.db.caching import disable_cache
+from djangae.db.cursors import starting_cursor, get_cursor, using_batch
 from djangae.db import transaction
 from djangae.fields import ComputedCharField, ShardedCounterField, SetField, ListField, GenericRelationField, RelatedSetField
 from djangae.models import CounterShard
+from djangae.db.backends.appengine import dnf
 from djangae.db.backends.appengine.dnf import parse_dnf
 from djangae.storage import BlobstoreFileUploadHandler
 from djangae.wsgi import DjangaeApplication
@@ -322,6 +324,64 @@ class BackendTests(TestCase):
         entity["name"] = [ "Bob", "Fred", "Dave" ]
         self.assertTrue(entity_matches_query(entity, query))  # ListField test
 
+    def test_entity_matches_multiquery(self):
+        entity = datastore.Entity("test_model")
+        entity["name"] = "Charlie"
+        entity["age"] = 22
+
+        young = datastore.Query("test_model")
+        young["age <"] = 18
+        charlie = datastore.Query("test_model")
+        charlie["name ="] = "Charlie"
+        other_kind = datastore.Query("other_model")
+        other_kind["name ="] = "Charlie"
+
+        # Matches if any of the branches match
+        self.assertTrue(entity_matches_query(entity, datastore.MultiQuery([young, charlie], [])))
+        self.assertFalse(entity_matches_query(entity, datastore.MultiQuery([young, other_kind], [])))
+
+        # A matcher can be reused for any number of entities
+        matches = QueryMatcher(datastore.MultiQuery([young, charlie], []))
+        fred = datastore.Entity("test_model")
+        fred["name"] = "Fred"
+        fred["age"] = 10
+        dave = datastore.Entity("test_model")
+        dave["name"] = "Dave"
+        dave["age"] = 30
+        self.assertEqual([True, True, False], [ matches(x) for x in (entity, fred, dave) ])
+
+    def test_ordering_sort_key(self):
+        entities = []
+        for i, (name, age) in enumerate([("A", 1), ("B", None), ("C", u"x"), ("D", 1.5), ("E", 1), ("F", 3)]):
+            entity = datastore.Entity("test_model", id=i + 1)
+            entity["name"] = name
+            entity["age"] = age
+            entities.append(entity)
+
+        # None sorts first, then integers, strings and floats, as they would in the datastore
+        ordering = [("age", datastore.Query.ASCENDING), ("name", datastore.Query.DESCENDING)]
+        results = sorted(entities, key=get_ordering_sort_key(ordering))
+        self.assertEqual(["B", "E", "A", "F", "C", "D"], [ x["name"] for x in results ])
+
+        ordering = [("age", datastore.Query.DESCENDING), ("__key__", datastore.Query.ASCENDING)]
+        results = sorted(entities, key=get_ordering_sort_key(ordering))
+        self.assertEqual(["D", "C", "F", "A", "E", "B"], [ x["name"] for x in results ])
+
+    def test_ordering_sort_key_on_list_values(self):
+        entities = []
+        for i, (name, tags) in enumerate([("A", [u"c", u"a"]), ("B", [u"b", u"z"]), ("C", [])]):
+            entity = datastore.Entity("test_model", id=i + 1)
+            entity["name"] = name
+            entity["tags"] = tags
+            entities.append(entity)
+
+        # Lists sort by their smallest value when ascending, and their largest when descending
+        results = sorted(entities, key=get_ordering_sort_key([("tags", datastore.Query.ASCENDING)]))
+        self.assertEqual(["C", "A", "B"], [ x["name"] for x in results ])
+
+        results = sorted(entities, key=get_ordering_sort_key([("tags", datastore.Query.DESCENDING)]))
+        self.assertEqual(["B", "A", "C"], [ x["name"] for x in results ])
+
     def test_defaults(self):
         fruit = TestFruit.objects.create(name="Apple", color="Red")
         self.assertEqual("Unknown", fruit.origin)
@@ -416,7 +476,7 @@ class BackendTests(TestCase):
             list(TestUser.objects.filter(username="test"))
             self.assertEqual(1, query_mock.call_count)
 
-        with sleuth.switch("djangae.db.backends.appengine.commands.datastore.MultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
+        with sleuth.switch("djangae.db.backends.appengine.commands.ParallelMultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
             list(TestUser.objects.filter(username__in=["test", "cheese"]))
             self.assertEqual(1, query_mock.call_count)
 
@@ -426,7 +486,7 @@ class BackendTests(TestCase):
 
         #FIXME: Issue #80
         with self.assertRaises(NotSupportedError):
-            with sleuth.switch("djangae.db.backends.appengine.commands.datastore.MultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
+            with sleuth.switch("djangae.db.backends.appengine.commands.ParallelMultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
                 list(TestUser.objects.exclude(username__startswith="test"))
                 self.assertEqual(1, query_mock.call_count)
 
@@ -445,6 +505,39 @@ class BackendTests(TestCase):
         self.assertItemsEqual([5, 10, 15], IntegerModel.objects.filter(integer_field__range=(5, 15)).order_by("integer_field").values_list("integer_field", flat=True))
         self.assertItemsEqual([5, 15], IntegerModel.objects.exclude(integer_field__range=(6, 14)).values_list("integer_field", flat=True))
 
+    def test_column_converters_are_built_once_per_query(self):
+        for i in xrange(5):
+            DateTimeModel.objects.create()
+        IterableFieldModel.objects.create(set_field={"a", "b"})
+
+        with sleuth.watch("djangae.db.backends.appengine.base.DatabaseOperations.get_value_converter") as get_converter:
+            results = list(DateTimeModel.objects.all())
+            self.assertEqual(5, len(results))
+            self.assertTrue(all(isinstance(x.datetime_field, datetime.datetime) for x in results))
+            self.assertTrue(all(isinstance(x.date_field, datetime.date) for x in results))
+
+            # Once for each of datetime_field and date_field (the key doesn't need one), not once per row
+            self.assertEqual(2, get_converter.call_count)
+
+        instance = IterableFieldModel.objects.get()
+        self.assertEqual({"a", "b"}, instance.set_field)
+        self.assertEqual([], instance.list_field)
+
+    def test_rows_are_fetched_in_batches(self):
+        for i in xrange(150):
+            IntegerModel.objects.create(integer_field=i)
+
+        with sleuth.watch("djangae.db.backends.appengine.base.Cursor.fetchone") as fetchone:
+            with sleuth.watch("djangae.db.backends.appengine.commands.SelectCommand.next_results") as next_results:
+                results = list(IntegerModel.objects.order_by("integer_field"))
+                self.assertEqual(range(150), [ x.integer_field for x in results ])
+
+                # Django asks for rows 100 at a time
+                self.assertEqual([100, 50, 0], [ len(x) for x in next_results.call_returns ])
+                self.assertFalse(fetchone.called)
+
+        self.assertEqual([5, 6], list(IntegerModel.objects.filter(integer_field__in=[5, 6]).order_by("integer_field").values_list("integer_field", flat=True)))
+
     def test_exclude_nullable_field(self):
         instance = ModelWithNullableCharField.objects.create(some_id=999) # Create a nullable thing
         instance2 = ModelWithNullableCharField.objects.create(some_id=999, field1="test") # Create a nullable thing
@@ -861,6 +954,59 @@ class QueryNormalizationTests(TestCase):
         ])
         self.assertEqual(expected, parse_dnf(qs.query.where, connection=connection)[0])
 
+    def test_queries_with_the_same_shape_are_only_normalised_once(self):
+        connection = connections['default']
+        dnf._normalised_cache.clear()
+
+        with sleuth.watch("djangae.db.backends.appengine.dnf._normalise") as normalise:
+            for username, emails in (("python", ["a@example.com", "b@example.com"]), ("ruby", ["c@example.com", "d@example.com"])):
+                qs = TestUser.objects.filter(username=username, email__in=emails)
+
+                expected = ('OR', [
+                    ('AND', [('LIT', ('username', '=', username)), ('LIT', ('email', '=', emails[0]))]),
+                    ('AND', [('LIT', ('username', '=', username)), ('LIT', ('email', '=', emails[1]))]),
+                ])
+                self.assertEqual(expected, parse_dnf(qs.query.where, connection=connection)[0])
+
+            self.assertEqual(1, normalise.call_count)
+
+            # A different number of values is a different shape
+            qs = TestUser.objects.filter(username="python", email__in=["a@example.com"])
+            parse_dnf(qs.query.where, connection=connection)
+            self.assertEqual(2, normalise.call_count)
+
+    def test_queries_with_many_values_arent_cached(self):
+        connection = connections['default']
+        dnf._normalised_cache.clear()
+
+        pks = range(1, dnf.NORMALISED_CACHE_MAX_LITERALS + 2)
+
+        with sleuth.watch("djangae.db.backends.appengine.dnf._normalise") as normalise:
+            for i in range(2):
+                qs = TestUser.objects.filter(pk__in=pks)
+                tree = parse_dnf(qs.query.where, connection=connection)[0]
+                self.assertEqual(len(pks), len(tree[-1]))
+
+            self.assertEqual(2, normalise.call_count)
+
+        self.assertFalse(dnf._normalised_cache)
+
+    def test_normalising_doesnt_hold_the_cache_lock(self):
+        connection = connections['default']
+        dnf._normalised_cache.clear()
+
+        original_normalise = dnf._normalise
+        lock_states = []
+
+        def normalise(template):
+            lock_states.append(dnf._normalised_cache_lock.locked())
+            return original_normalise(template)
+
+        with sleuth.switch("djangae.db.backends.appengine.dnf._normalise", normalise):
+            qs = TestUser.objects.filter(username="python", email__in=["a@example.com", "b@example.com"])
+            parse_dnf(qs.query.where, connection=connection)
+
+        self.assertEqual([False], lock_states)
 
 
 
@@ -1495,6 +1641,57 @@ class EdgeCaseTests(TestCase):
         query = TestUser.objects.filter(pk__in=list(xrange(1, 32)))
         list(query)
 
+    def test_large_pk_in_with_other_filters_uses_a_get(self):
+        # Every branch of the OR looks up a key, so the keys are fetched and the username
+        # filter is applied in memory
+        query = TestUser.objects.filter(pk__in=list(xrange(1, 41)), username__in=["A", "C"])
+
+        with disable_cache():
+            with sleuth.watch("djangae.db.backends.appengine.commands.datastore.Query.Run") as query_run:
+                with sleuth.watch("djangae.db.backends.appengine.commands.datastore.Get") as datastore_get:
+                    self.assertItemsEqual([self.u1, self.u3], list(query))
+                    self.assertFalse(query_run.called)
+                    self.assertEqual(1, datastore_get.call_count)
+                    self.assertEqual(40, len(datastore_get.calls[0][0][0]))
+
+    def test_in_query_branches_are_merged_in_order(self):
+        # u1 and u2 match both branches of the OR, but must only be returned once
+        query = TestUser.objects.filter(
+            Q(email__in=["test@example.com", "test3@example.com"]) | Q(username__in=["A", "B", "C"])
+        )
+
+        with sleuth.watch("djangae.db.backends.appengine.commands.datastore.Query.Run") as query_run:
+            results = list(query.order_by("-username"))
+            self.assertEqual(5, query_run.call_count)
+
+        self.assertEqual([self.u5, self.u4, self.u3, self.u2, self.u1], results)
+        self.assertEqual([self.u4, self.u3], list(query.order_by("-username")[1:3]))
+        self.assertEqual([self.u1, self.u2, self.u3], list(query.order_by("username")[:3]))
+        self.assertEqual(5, query.count())
+        self.assertEqual(2, query[1:3].count())
+        self.assertEqual([self.u1.pk, self.u2.pk], list(query.order_by("pk").values_list("pk", flat=True)[:2]))
+
+    def test_ordered_in_query_count_matches_its_results(self):
+        # The datastore leaves entities without the ordered property out of ordered queries
+        entity = datastore.Get(datastore.Key.from_path(TestUser._meta.db_table, self.u3.pk))
+        del entity["field2"]
+        datastore.Put(entity)
+
+        # Django only keeps the ordering on a count if the query is sliced
+        query = TestUser.objects.filter(username__in=["A", "B", "C"]).order_by("field2")[:3]
+        self.assertEqual([self.u1, self.u2], list(query))
+        self.assertEqual(2, query.count())
+
+    def test_in_query_branches_are_merged_in_order_of_a_list_field(self):
+        first = IterableFieldModel.objects.create(list_field=["C", "A"], set_field=set(["X"]))
+        second = IterableFieldModel.objects.create(list_field=["B", "Z"], set_field=set(["Y"]))
+
+        # The datastore orders lists by their smallest value ascending, and their largest descending
+        query = IterableFieldModel.objects.filter(set_field__in=["X", "Y"])
+        self.assertEqual([first, second], list(query.order_by("list_field")))
+        self.assertEqual([second, first], list(query.order_by("-list_field")))
+        self.assertEqual([first], list(query.order_by("-list_field")[1:]))
+
     def test_self_relations(self):
         obj = SelfRelatedModel.objects.create()
         obj2 = SelfRelatedModel.objects.create(related=obj)
@@ -1534,6 +1731,81 @@ class EdgeCaseTests(TestCase):
 
 
 
+class CursorTests(TestCase):
+    def setUp(self):
+        super(CursorTests, self).setUp()
+        for i in xrange(10):
+            IntegerModel.objects.create(integer_field=i)
+
+    def test_paging_with_cursors(self):
+        queryset = IntegerModel.objects.order_by("integer_field")
+
+        page = starting_cursor(queryset, None)[:4]
+        self.assertEqual([0, 1, 2, 3], [ x.integer_field for x in page ])
+
+        cursor = get_cursor(page)
+        self.assertTrue(cursor)
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            page = starting_cursor(queryset, cursor)[:4]
+            self.assertEqual([4, 5, 6, 7], [ x.integer_field for x in page ])
+            self.assertFalse(datastore_query.calls[0][1].get("offset"))
+
+        # Slices are relative to the cursor, and cloning the queryset keeps it
+        page = starting_cursor(queryset, get_cursor(page)).all()[1:]
+        self.assertEqual([9], [ x.integer_field for x in page ])
+
+    def test_get_cursor_evaluates_the_queryset(self):
+        queryset = IntegerModel.objects.order_by("integer_field")[:5]
+        cursor = get_cursor(queryset)
+
+        self.assertEqual(5, len(queryset))
+        self.assertEqual([5, 6], [ x.integer_field for x in starting_cursor(IntegerModel.objects.order_by("integer_field"), cursor)[:2] ])
+
+        evaluated = IntegerModel.objects.all()
+        list(evaluated)
+        self.assertRaises(ValueError, get_cursor, evaluated)
+
+    def test_cursors_arent_supported_with_multiple_queries(self):
+        queryset = starting_cursor(IntegerModel.objects.filter(integer_field__in=[1, 2]), None)
+        self.assertRaises(NotSupportedError, list, queryset)
+
+    def test_cursors_arent_supported_with_primary_key_lookups(self):
+        instance = IntegerModel.objects.get(integer_field=1)
+
+        queryset = starting_cursor(IntegerModel.objects.filter(pk=instance.pk), None)
+        self.assertRaises(NotSupportedError, list, queryset)
+        self.assertRaises(NotSupportedError, get_cursor, IntegerModel.objects.filter(pk=instance.pk))
+
+    def test_get_cursor_before_the_last_batch_is_finished(self):
+        def no_cursor(*args, **kwargs):
+            raise AssertionError("No cursor available")
+
+        queryset = IntegerModel.objects.order_by("integer_field")[:5]
+        with sleuth.switch("google.appengine.api.datastore.Query.GetCursor", no_cursor):
+            self.assertIsNone(get_cursor(queryset))
+
+        self.assertEqual(5, len(queryset))
+
+    def test_batch_sizes_are_passed_to_the_datastore(self):
+        queryset = using_batch(IntegerModel.objects.order_by("integer_field"), 3).filter(integer_field__gte=2)
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            self.assertEqual(range(2, 10), [ x.integer_field for x in queryset ])
+            self.assertEqual(3, datastore_query.calls[0][1]["batch_size"])
+            self.assertEqual(3, datastore_query.calls[0][1]["prefetch_size"])
+
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as datastore_query:
+            queryset = using_batch(IntegerModel.objects.filter(integer_field__in=[1, 2]), 100, prefetch_size=10)
+            self.assertItemsEqual([1, 2], [ x.integer_field for x in queryset ])
+
+            # Each of the queries run for the IN gets the options
+            self.assertEqual(2, datastore_query.call_count)
+            for call in datastore_query.calls:
+                self.assertEqual(100, call[1]["batch_size"])
+                self.assertEqual(10, call[1]["prefetch_size"])
+
+
 class BlobstoreFileUploadHandlerTest(TestCase):
     boundary = "===============7417945581544019063=="
 